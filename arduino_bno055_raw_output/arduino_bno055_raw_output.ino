@@ -4,6 +4,7 @@
 #include <utility/imumaths.h>
 
 #define BNO055_SAMPLERATE_DELAY_MS (10) //this defines the samplerate of the sensor
+#define PROTOCOL_VERSION (1) //1: sync pattern + packet. 2: sync pattern + length + sequence + packet + CRC (set protocol=2 in SerialRead)
 Adafruit_BNO055 myIMU = Adafruit_BNO055(); //create IMU object 
 
 struct{
@@ -14,6 +15,23 @@ struct{
     imu::Quaternion quaternions; //looks like this is 4 vector of doubles
 }my_serial_packet;
 
+uint16_t sequence_number = 0;
+
+//CRC-16/CCITT (poly 0x1021), matches python's binascii.crc_hqx(data, 0xFFFF)
+uint16_t crc16_update(uint16_t crc, byte data){
+    crc ^= (uint16_t)data << 8;
+    for (int i=0;i<8;i++){
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+    return crc;
+}
+
+//writes a byte and folds it into the running CRC
+uint16_t write_with_crc(uint16_t crc, byte data){
+    Serial.write(data);
+    return crc16_update(crc, data);
+}
+
 void setup() {
     Serial.begin(115200);
     myIMU.begin(); 
@@ -42,9 +60,25 @@ void loop() {
     Serial.write(byte(0));
     Serial.write(byte(255));
     byte* b = (byte *) &my_serial_packet;
+#if PROTOCOL_VERSION == 2
+    //little endian length and sequence counter, then the packet, then the CRC over all of them
+    uint16_t crc = 0xFFFF;
+    uint16_t packet_length = sizeof(my_serial_packet);
+    crc = write_with_crc(crc, packet_length & 0xFF);
+    crc = write_with_crc(crc, packet_length >> 8);
+    crc = write_with_crc(crc, sequence_number & 0xFF);
+    crc = write_with_crc(crc, sequence_number >> 8);
+    for (int i=0;i<sizeof(my_serial_packet);i++){
+        crc = write_with_crc(crc, *(b+i));
+    };
+    Serial.write(crc & 0xFF);
+    Serial.write(crc >> 8);
+    sequence_number++;
+#else
     for (int i=0;i<sizeof(my_serial_packet);i++){
         Serial.write(*(b+i));
     };
+#endif
     // transmit each double
     // byte * b = (byte *) &accel_vector;
     // for (int i=0;i<sizeof(accel_vector);i++){
@@ -0,0 +1,113 @@
+import numpy as np
+import quaternion_math
+
+#channels computed from the decoded streams inside the reader process, one vectorized pass per batch of records
+#a channel owns a data class object (name, display, format) so it is logged, published and plotted like a raw stream,
+#but its field is never part of the packet the sketch sends. inputs are field names of raw streams or of channels
+#declared earlier in the same list. batches are stamped with one arrival time, so rates come from sample_rate_hz
+#(the sketch's BNO055_SAMPLERATE_DELAY_MS of 10 is 100 Hz)
+
+
+class DerivedChannel:
+    def __init__(self, data_stream, inputs):
+        self.data_stream = data_stream
+        self.name = data_stream.name
+        self.inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+
+    def input_values(self, records):
+        #(N, n_values) float64, from several scalar fields or a single vector field
+        return np.column_stack([records[name] for name in self.inputs]).astype(np.float64)
+
+    def compute(self, records):
+        raise NotImplementedError
+
+
+class Magnitude(DerivedChannel):
+    #e.g. Magnitude(GenericSerialData('Accel Magnitude', ...), ['Accel X', 'Accel Y', 'Accel Z'])
+    def compute(self, records):
+        return np.linalg.norm(self.input_values(records), axis=1)
+
+
+class LowPass(DerivedChannel):
+    #first order IIR y[n] = a*y[n-1] + (1-a)*x[n], applied block_size samples at a time as one matmul with the
+    #precomputed impulse response, so there is no python loop per sample. state carries over between batches
+    def __init__(self, data_stream, inputs, cutoff_hz, sample_rate_hz=100.0, block_size=64):
+        super().__init__(data_stream, inputs)
+        self.cutoff_hz = cutoff_hz
+        self.sample_rate_hz = sample_rate_hz
+        self.block_size = block_size
+        self.alpha = np.exp(-2*np.pi*cutoff_hz/sample_rate_hz)
+        lags = np.subtract.outer(np.arange(block_size), np.arange(block_size))
+        self.impulse_response = np.where(lags >= 0, (1 - self.alpha)*self.alpha**np.maximum(lags, 0), 0.0)
+        self.state_decay = self.alpha**np.arange(1, block_size + 1)[:, np.newaxis]
+        self.state = None #last output, starts at the first input so there is no startup ramp
+
+    def filter(self, values):
+        if not len(values):
+            return values
+        if self.state is None:
+            self.state = values[0]
+        filtered = np.empty_like(values)
+        for start in range(0, len(values), self.block_size):
+            block = values[start:start+self.block_size]
+            n = len(block)
+            filtered[start:start+n] = self.impulse_response[:n, :n] @ block + self.state_decay[:n]*self.state
+            self.state = filtered[start+n-1]
+        return filtered
+
+    def compute(self, records):
+        return self.filter(self.input_values(records))
+
+
+class HighPass(LowPass):
+    #complement of the low-pass, e.g. to take the slow drift out of a gyro axis
+    def compute(self, records):
+        values = self.input_values(records)
+        return values - self.filter(values)
+
+
+class GyroIntegration(DerivedChannel):
+    #orientation quaternion from body rates: q[n] = q[n-1] * dq[n]. the running product over a batch is a prefix scan
+    #with quaternion_math.multiply (log2(N) vectorized steps), then the orientation at the end of the last batch is applied
+    def __init__(self, data_stream, inputs, sample_rate_hz=100.0, degrees=True):
+        super().__init__(data_stream, inputs)
+        self.sample_rate_hz = sample_rate_hz
+        self.degrees = degrees #the Adafruit library reports the BNO055 gyro in degrees per second
+        self.orientation = np.array([1.0, 0.0, 0.0, 0.0])
+
+    def compute(self, records):
+        rates = self.input_values(records)
+        if self.degrees:
+            rates = np.radians(rates)
+        if not len(rates):
+            return np.empty((0, 4))
+        dt = 1/self.sample_rate_hz
+        speeds = np.linalg.norm(rates, axis=1, keepdims=True)
+        half_angles = 0.5*speeds*dt
+        #sin(|w|dt/2)/|w| tends to dt/2 when the rate is zero
+        scale = np.where(speeds > 0, np.sin(half_angles)/np.where(speeds > 0, speeds, 1.0), 0.5*dt)
+        rotations = np.hstack((np.cos(half_angles), rates*scale))
+        offset = 1
+        while offset < len(rotations):
+            rotations[offset:] = quaternion_math.multiply(rotations[:-offset], rotations[offset:])
+            offset *= 2
+        orientations = quaternion_math.normalize(quaternion_math.multiply(self.orientation, rotations))
+        self.orientation = orientations[-1]
+        return orientations
+
+
+class EulerToQuaternion(DerivedChannel):
+    #BNO055 (heading, roll, pitch) to a (w, x, y, z) quaternion, e.g. to compare against the sensor's own quaternion
+    def __init__(self, data_stream, inputs, degrees=True):
+        super().__init__(data_stream, inputs)
+        self.degrees = degrees
+
+    def compute(self, records):
+        return quaternion_math.from_euler(self.input_values(records), self.degrees)
+
+
+def compute_derived(records, derived_channels):
+    #fills the derived fields of a batch in place, in declaration order
+    for channel in derived_channels:
+        records[channel.name] = np.reshape(channel.compute(records), records[channel.name].shape)
+    return records
@@ -1,94 +1,343 @@
+import time
+START_TIME = time.perf_counter() #for --report-startup, taken before Qt is imported
 from flight_display_parent import Ui_MainWindow
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
-import csv
-from user_serial_data_classes import GenericSerialData, QuaternionShapeSerialData, EulerSerialData
-from serial_reading_handler import SerialRead
-import multiprocessing as mp
+from frame_schema import FrameSchema
+from flight_log import FlightLogWriter, LegacyCsvWriter
+from perf_counters import pipeline_counters, PerfMonitor, ProfilerToggle
+from render_scheduler import RenderScheduler
+from spectrum_view import imu_spectrum_views
+from minmax_history import GrowableArray
+from session_store import SessionStore, SessionHistory
+from frame_publisher import streams_from_header
+from headless_capture import add_capture_arguments, start_capture, make_sinks, make_trigger_capture, startup_report
 import threading
+import argparse
+import json
+import numpy as np
 
 class FlightDisplay(Ui_MainWindow):
     #UI_MainWindow has its own __init__ method or something so no init is necessary
-    def user_setup(self, data_streams, running_queue, data_queue):
+    def user_setup(self, data_streams, serial_reader, data_ring, log_path='data_out.imulog', legacy_csv_path=None, perf_counters=None, perf_log_path=None, frame_schema=None, target_fps=None, sinks=(), views=(), markers=None,
+                   buffer_policy='drop-newest', max_pending_records=8192):
         #pack all graphics widgets (2d/3d plots for now) into a display map for plot updater to find
         self.data_streams = data_streams
+        self.frame_schema = frame_schema if frame_schema is not None else FrameSchema(data_streams) #log layout, e.g. merged_schema for several devices
+        self.log_path = log_path #None for no continuous log, e.g. when only trigger bursts are written
+        self.legacy_csv_path = legacy_csv_path #set to e.g. 'data_out.csv' to also write the old text log
+        self.sinks = list(sinks) #more writers fed the logged batches, e.g. a FramePublisher
+        #displays fed from the data handler thread instead of a record field, e.g. spectrum_view.SpectrumView. views may share one analysis
+        self.views = list(views)
+        self.spectra = list({id(view.spectrum):view.spectrum for view in self.views}.values())
+        self.markers = markers #anything with events() -> sample numbers to mark on the strip charts, e.g. a TriggerCapture (also passed as a sink)
+        self.n_drawn_markers = 0
+        #markers are numbered in logged records, the strip chart x axis in drawn samples. when the display drops or
+        #decimates (buffer_policy) the two part, so the logged record number of every drawn sample is kept to map markers
+        self.n_logged_records = 0
+        self.drawn_samples = GrowableArray(np.int64)
 
         #setup process logistics
         self.running = False #controls data logging/plotting, setting false stops logging
-        self.running_queue = running_queue #pass to serial reader/main. main tells reader to stop on exit.
-        self.data_queue = data_queue
+        self.stop_event = threading.Event() #wakes the data handler even before any data has arrived
+        self.serial_reader = serial_reader #control channel to the reader process (start/stop/pause/resume/configure/shutdown)
+        self.reader_paused = False
+        self.first_record_time = None
+        self.data_ring = data_ring #shared memory ring filled by the serial reader process
+        self.pending_records = [] #batches logged since the last plot refresh
+        self.pending_samples = [] #their logged record numbers, trimmed together with them
+        self.pending_count = 0
+        self.pending_lock = threading.Lock()
+        self.pending_drained = threading.Condition(self.pending_lock) #notified by the GUI thread when it took the pending batches
+        #the plots get at most max_pending_records per refresh. when they fall behind, buffer_policy (see --buffer-policy) blocks
+        #the data handler until they catch up, drops the oldest or newest pending records, or keeps every other one.
+        #logging and the sinks always see every record the ring handed out. dropped or decimated records never reach the
+        #strip charts, so their x axis (drawn samples) then runs behind the logged record count
+        self.buffer_policy = buffer_policy
+        self.max_pending_records = max_pending_records
+        self.drawn_timestamp = None #arrival time of the newest drawn record, for the behind live indicator
+        self.behind_live_s = 0.25
+
+        #stage counters shared with the reader process, summarized in the statusbar and optionally appended to perf_log_path
+        self.perf_counters = perf_counters if perf_counters is not None else pipeline_counters(data_streams)
+        self.perf_monitor = PerfMonitor(self.perf_counters, perf_log_path)
+        self.profiler_toggle = ProfilerToggle() #F9 starts/stops cProfile of the GUI thread
+
+        self.behind_live_label = QtWidgets.QLabel('BEHIND LIVE')
+        self.behind_live_label.setStyleSheet('color: white; background-color: red; font-weight: bold; padding: 0 6px')
+        self.behind_live_label.hide()
+        self.statusbar.addPermanentWidget(self.behind_live_label)
 
         #construct dictionary of plot handling objects. they are identified by 'plotobj'; this must be set in the object creation
         self.plotobj_dict = {key:value for (key, value) in self.__dict__.items() if 'plotobj' in key}
-        for data_stream in data_streams:
+        #streams without a display (e.g. derived channels that are only logged) are not drawn
+        self.plotted_streams = [data_stream for data_stream in data_streams if data_stream.display is not None]
+        for data_stream in self.plotted_streams:
             data_stream.add_plot_handler(self.plotobj_dict[data_stream.display])
+        n_designer_plots = len(self.plotobj_dict)
+        for view in self.views:
+            if view.display not in self.plotobj_dict:
+                self.plotobj_dict[view.display] = self.add_view_widget(view.display, len(self.plotobj_dict) - n_designer_plots)
+            view.add_plot_handler(self.plotobj_dict[view.display])
         #connect pushButton to stop_collection function
         self.pushButton.clicked.connect(self.stop_collection)
 
         #setup background data handler thread
-        data_handler = threading.Thread(target=self.data_handler)
-        data_handler.start()
-        #setup GUI (plot refresh) updating
+        self.data_handler_thread = threading.Thread(target=self.data_handler)
+        self.data_handler_thread.start()
+        #setup GUI (plot refresh) updating, one tick per display refresh unless target_fps is given
+        if target_fps is None:
+            target_fps = QtWidgets.QApplication.primaryScreen().refreshRate() or 60.0
+        self.render_scheduler = RenderScheduler(self.plotted_streams, self.perf_counters, target_fps, views=self.views)
         self.timer = QtCore.QTimer()
-        self.timer.setInterval(10)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.setInterval(max(round(1000/target_fps), 1))
         self.timer.timeout.connect(self.update_plot_data)
         self.timer.start()      
+        self.perf_timer = QtCore.QTimer()
+        self.perf_timer.setInterval(1000)
+        self.perf_timer.timeout.connect(self.update_perf_status)
+        self.perf_timer.start()
+        self.profile_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('F9'), self.centralwidget)
+        self.profile_shortcut.activated.connect(self.toggle_profiler)
+        self.pause_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('P'), self.centralwidget)
+        self.pause_shortcut.activated.connect(self.toggle_pause)
+
+    def review_setup(self, session_store):
+        #scrubs a stored session instead of capturing: the strip charts draw its columns through SessionHistory (pan/zoom
+        #as live), the slider puts their right edge at a sample and the 3D views show the sample there
+        from plot_renderers import SPECTRUM_COLORS
+        self.session_store = session_store
+        self.plotobj_dict = {key:value for (key, value) in self.__dict__.items() if 'plotobj' in key}
+        self.plotted_streams = [data_stream for data_stream in streams_from_header(session_store.header) if data_stream.display in self.plotobj_dict]
+        n_display_streams = {}
+        for data_stream in self.plotted_streams:
+            if hasattr(data_stream, 'history'):
+                data_stream.history = SessionHistory(session_store, data_stream.name)
+                #the header has no colours, streams sharing a strip chart get the spectrum colours in order
+                data_stream.color = SPECTRUM_COLORS[n_display_streams.get(data_stream.display, 0) % len(SPECTRUM_COLORS)]
+                n_display_streams[data_stream.display] = n_display_streams.get(data_stream.display, 0) + 1
+            data_stream.add_plot_handler(self.plotobj_dict[data_stream.display])
+        self.pushButton.setEnabled(False) #nothing to stop
+        self.scrub_label = QtWidgets.QLabel()
+        self.scrub_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+        self.scrub_slider.setRange(0, len(session_store))
+        self.scrub_slider.valueChanged.connect(self.scrub)
+        self.statusbar.addWidget(self.scrub_slider, 1)
+        self.statusbar.addPermanentWidget(self.scrub_label)
+        self.scrub_slider.setValue(len(session_store))
+        self.scrub(len(session_store))
+
+    def scrub(self, sample):
+        #sample is the number of records up to the right edge
+        sample_data = self.session_store.records(sample - 1, sample) if sample else None
+        for data_stream in self.plotted_streams:
+            if hasattr(data_stream, 'scroll_to'):
+                data_stream.scroll_to(sample)
+            elif sample:
+                data_stream.update_plot_batch(sample_data[data_stream.name])
+        t_start, _ = self.session_store.time_range()
+        time_text = f' | {sample_data["timestamp"][0] - t_start:.2f} s' if sample else ''
+        self.scrub_label.setText(f'sample {sample}/{len(self.session_store)}{time_text}')
 
     def data_handler(self):
-        openfile = open('data_out.csv','w',newline='')
-        csvwriter = csv.writer(openfile)
-        #empty the queue
-        while not self.data_queue.empty(): 
-            self.data_queue.get()
-        #wait for start of data flow and start program
-        self.data_buff = self.data_queue.get()
-        self.running = True #turn sync on when data queue starts filling
-        while self.running:
-            if not self.data_queue.empty(): #does this continuouslty checking if the queue is empty present a performance issue?
-                self.data_buff = self.data_queue.get() 
-                csvwriter.writerow(self.data_buff)
+        log_writers = [FlightLogWriter(self.log_path, self.frame_schema)] if self.log_path else []
+        if self.legacy_csv_path:
+            log_writers.append(LegacyCsvWriter(self.legacy_csv_path, self.data_streams))
+        log_writers.extend(self.sinks)
+        #empty the ring
+        self.data_ring.discard()
+        #wait for start of data flow and start program. the waits block on the ring's data event, the timeout only bounds how late a stop is noticed
+        while not self.stop_event.is_set() and not self.data_ring.wait(0.1):
+            pass
+        if not self.stop_event.is_set():
+            self.first_record_time = time.perf_counter()
+            self.running = True #turn sync on when data ring starts filling. set first so the plots get the first batch too and sample numbers match the markers
+            self.log_records(log_writers)
+        while not self.stop_event.is_set():
+            if self.data_ring.wait(0.1):
+                self.log_records(log_writers)
+        for log_writer in log_writers:
+            log_writer.close()
         print('data handler stopped')  
 
+    def log_records(self, log_writers):
+        #one copy out of the ring is shared by the log writer threads and the plots
+        write_start = time.perf_counter()
+        self.perf_counters.set('handler_ring_depth', self.data_ring.available())
+        records = self.data_ring.read()
+        self.perf_counters.set('handler_ring_dropped_frames', self.data_ring.dropped_frames())
+        if not len(records): #drop-oldest: the reader wrote over everything while it was copied
+            return
+        for log_writer in log_writers:
+            log_writer.write(records)
+        self.queue_for_display(records)
+        self.perf_counters.add('handler_batches')
+        self.perf_counters.add('handler_records', len(records))
+        self.perf_counters.add('handler_write_s', time.perf_counter() - write_start)
+        if self.spectra:
+            spectrum_start = time.perf_counter()
+            for spectrum in self.spectra:
+                spectrum.add(records)
+            self.perf_counters.add('handler_spectrum_s', time.perf_counter() - spectrum_start)
+
+    def queue_for_display(self, records):
+        #pending batches are never empty, update_plot_data takes the newest timestamp from the last one
+        if not len(records):
+            return
+        with self.pending_drained:
+            if self.buffer_policy == 'block':
+                block_start = time.perf_counter()
+                while self.pending_count and self.pending_count + len(records) > self.max_pending_records and not self.stop_event.is_set():
+                    self.pending_drained.wait(0.1)
+                self.perf_counters.add('display_blocked_s', time.perf_counter() - block_start)
+            self.pending_records.append(records)
+            self.pending_samples.append(np.arange(self.n_logged_records, self.n_logged_records + len(records)))
+            self.n_logged_records += len(records)
+            self.pending_count += len(records)
+            if self.buffer_policy == 'block' or self.pending_count <= self.max_pending_records:
+                return
+            pending, pending_samples = np.concatenate(self.pending_records), np.concatenate(self.pending_samples)
+            if self.buffer_policy == 'drop-oldest':
+                kept = slice(-self.max_pending_records, None)
+            elif self.buffer_policy == 'drop-newest':
+                kept = slice(self.max_pending_records)
+            else: #decimate, the strip charts advance one sample per kept record
+                kept = slice(None, None, 2**int(np.ceil(np.log2(len(pending)/self.max_pending_records))))
+            pending, pending_samples = pending[kept], pending_samples[kept]
+            self.perf_counters.add('display_decimated_frames' if self.buffer_policy == 'decimate' else 'display_dropped_frames', self.pending_count - len(pending))
+            self.pending_records, self.pending_samples = [pending], [pending_samples]
+            self.pending_count = len(pending)
+
+    def add_view_widget(self, display, index):
+        #views whose display is not in the designer layout get a plot in the free column right of the strip charts,
+        #below the stop button so they never cover it
+        from pyqtgraph import PlotWidget
+        plot_widget = PlotWidget(self.centralwidget)
+        top = self.pushButton.geometry().bottom() + 10
+        plot_widget.setGeometry(QtCore.QRect(1730, top + 680*index, 820, 670))
+        plot_widget.setObjectName(display)
+        return plot_widget
+
     def update_plot_data(self):
-        for i, data_stream in enumerate(self.data_streams):
-            if not self.running:
-                break
-            data_stream.update_plot(self.data_buff[i])
+        #every sample since the last refresh is drawn, not only the latest one. the scheduler only redraws streams with new data
+        with self.pending_drained:
+            pending_records, self.pending_records = self.pending_records, []
+            pending_samples, self.pending_samples = self.pending_samples, []
+            self.pending_count = 0
+            self.pending_drained.notify()
+        if not self.running:
+            return
+        if pending_records:
+            self.drawn_timestamp = pending_records[-1]['timestamp'][-1]
+            self.render_scheduler.add(pending_records[0] if len(pending_records) == 1 else np.concatenate(pending_records))
+            if self.markers is not None:
+                self.drawn_samples.extend(np.concatenate(pending_samples))
+        #how old the newest drawn sample is while more is waiting in the ring. idle or paused is not behind
+        if self.drawn_timestamp is not None and (pending_records or self.data_ring.available()):
+            self.perf_counters.set('display_lag_s', max(time.time() - self.drawn_timestamp, 0.0))
+        else:
+            self.perf_counters.set('display_lag_s', 0.0)
+        self.render_scheduler.render_frame()
+        if self.markers is not None:
+            self.update_markers()
+
+    def update_markers(self):
+        #an event is marked once its record was drawn or skipped, on the first drawn sample at or after it
+        drawn_samples = self.drawn_samples.view()
+        if not len(drawn_samples):
+            return
+        event_samples = self.markers.events()
+        event_samples = event_samples[event_samples <= drawn_samples[-1]]
+        if len(event_samples) == self.n_drawn_markers:
+            return
+        self.n_drawn_markers = len(event_samples)
+        marker_samples = np.searchsorted(drawn_samples, event_samples)
+        for data_stream in self.plotted_streams:
+            if hasattr(data_stream, 'set_markers'):
+                data_stream.set_markers(marker_samples)
+
+    def update_perf_status(self):
+        stats = self.perf_monitor.sample()
+        self.statusbar.showMessage(self.perf_monitor.status_text(stats))
+        behind_live = stats['display_lag_s'] > self.behind_live_s
+        if behind_live:
+            self.behind_live_label.setText(f"BEHIND LIVE {stats['display_lag_s']:.1f} s")
+        self.behind_live_label.setVisible(behind_live)
+
+    def toggle_profiler(self):
+        profile_path = self.profiler_toggle.toggle()
+        self.statusbar.showMessage(f'profile written to {profile_path}' if profile_path else 'profiling GUI thread (F9 to stop)', 2000)
 
-    def stop_collection(self): #PyQt app recognizes this and executes on closing window
+    def toggle_pause(self):
+        #P pauses/resumes the reader. the port stays open and logging picks up again on resume
+        self.reader_paused = not self.reader_paused
+        if self.reader_paused:
+            self.serial_reader.pause()
+        else:
+            self.serial_reader.resume()
+        self.statusbar.showMessage('reader paused (P to resume)' if self.reader_paused else 'reader resumed', 2000)
+
+    def stop_collection(self): #PyQt app recognizes this and executes on closing window. safe to call more than once
         self.running = False
-        self.running_queue.put(False)
+        self.timer.stop()
+        self.perf_timer.stop()
+        self.serial_reader.shutdown()
+        self.stop_event.set()
+        self.data_handler_thread.join() #log writers are flushed and closed once this returns
 
 
 if __name__=='__main__':
-    #user setup
-    #this must be in order of which data is transmitted
-    data_queue = mp.SimpleQueue()
-    running_queue = mp.SimpleQueue()
-    data_streams = [
-        GenericSerialData('Accel X', 'plotobj_strip_chart_1'),
-        GenericSerialData('Accel Y', 'plotobj_strip_chart_2'),
-        GenericSerialData('Accel Z', 'plotobj_strip_chart_3'),
-        GenericSerialData('Gyro X', 'plotobj_strip_chart_4'),
-        GenericSerialData('Gyro Y', 'plotobj_strip_chart_5'),
-        GenericSerialData('Gyro Z', 'plotobj_strip_chart_6'),
-        EulerSerialData('Euler Data','plotobj_Euler_Plot'),
-        QuaternionShapeSerialData('Quat Data','plotobj_Quat_Plot')
-    ]
-
-    #start serial reading process
-    port = 'COM3'
-    baudrate = 115200
-    timeout = 5
-    SerialRead(port, baudrate, timeout, data_streams, data_queue, running_queue)
+    parser = argparse.ArgumentParser(description='IMU flight display')
+    add_capture_arguments(parser)
+    parser.add_argument('--fps', type=float, help='plot refresh rate, defaults to the screen refresh rate')
+    parser.add_argument('--spectrum', action='store_true', help='show live accel/gyro power spectra and an Accel Z waterfall')
+    parser.add_argument('--review', metavar='DIR', help='scrub through a stored --session instead of capturing')
+    args = parser.parse_args()
+
+    if args.review:
+        app = QtWidgets.QApplication(sys.argv)
+        MainWindow = QtWidgets.QMainWindow()
+        ui = FlightDisplay()
+        ui.setupUi(MainWindow)
+        ui.review_setup(SessionStore(args.review))
+        MainWindow.show()
+        if args.duration:
+            QtCore.QTimer.singleShot(int(args.duration*1000), app.quit)
+        sys.exit(app.exec_())
+
+    #user setup, see imu_data_streams for the stream layout
+    data_streams, frame_schema, data_ring, perf_counters, serial_reader = start_capture(args)
+    views = []
+    if args.spectrum:
+        #the first device's channels when several are merged
+        prefix = next(data_stream.name[:-len('Accel X')] for data_stream in data_streams if data_stream.name.endswith('Accel X'))
+        views = imu_spectrum_views(prefix, args.sample_rate)
+    try:
+        trigger_capture = make_trigger_capture(args, frame_schema)
+    except ValueError: #e.g. a trigger on a stream that is not in the schema
+        serial_reader.shutdown()
+        data_ring.close()
+        raise
+    sinks = make_sinks(args, frame_schema)
+    if trigger_capture is not None:
+        sinks.append(trigger_capture)
 
     #run core app
     app = QtWidgets.QApplication(sys.argv)
     MainWindow = QtWidgets.QMainWindow()
     ui = FlightDisplay()
     ui.setupUi(MainWindow)
-    ui.user_setup(data_streams, running_queue, data_queue)
+    ui.user_setup(data_streams, serial_reader, data_ring, log_path=None if args.no_log else args.log, legacy_csv_path=args.legacy_csv, perf_counters=perf_counters, perf_log_path=args.perf_log,
+                  frame_schema=frame_schema, target_fps=args.fps, sinks=sinks, views=views, markers=trigger_capture,
+                  buffer_policy=args.buffer_policy)
+    app.aboutToQuit.connect(ui.stop_collection) #closing the window shuts the reader down and joins everything
     MainWindow.show()
-    sys.exit(app.exec_())
-
-    
\ No newline at end of file
+    ready_time = time.perf_counter()
+    if args.duration:
+        QtCore.QTimer.singleShot(int(args.duration*1000), app.quit)
+    exit_code = app.exec_()
+    data_ring.close()
+    if args.report_startup:
+        print(json.dumps(startup_report('gui', START_TIME, ready_time, ui.first_record_time)))
+    sys.exit(exit_code)
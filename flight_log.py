@@ -0,0 +1,137 @@
+import argparse
+import csv
+import json
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from frame_schema import dtype_from_json
+
+#file layout: MAGIC, uint32 header length, json header (padded to 64 bytes), then fixed width records back to back
+MAGIC = b'IMULOG1\n'
+HEADER_ALIGNMENT = 64
+
+
+class FlightLogWriter:
+    #binary columnar-friendly log. records are written on a dedicated thread in large buffered chunks
+    #at most max_pending_batches wait for the disk, then write blocks: a slow disk holds up the data handler, so the
+    #backlog stays in the ring where --buffer-policy decides about it instead of growing in memory
+    def __init__(self, path, frame_schema, chunk_records=4096, extra_header=None, max_pending_batches=256):
+        self.path = path
+        self.record_dtype = frame_schema.record_dtype
+        self.openfile = open(path, 'wb', buffering=chunk_records*self.record_dtype.itemsize)
+        header = frame_schema.describe()
+        header['created'] = time.time()
+        header.update(extra_header or {}) #e.g. the trigger time of a burst file
+        self.openfile.write(encode_header(header))
+
+        self.record_queue = queue.Queue(max_pending_batches)
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.start()
+
+    def write(self, records):
+        #records must not be modified by the caller afterwards (pass a copy of ring views)
+        self.record_queue.put(records)
+
+    def writer_loop(self):
+        while True:
+            records = self.record_queue.get()
+            if records is None:
+                break
+            self.openfile.write(records.tobytes())
+        self.openfile.close()
+
+    def close(self):
+        self.record_queue.put(None)
+        self.writer_thread.join()
+
+
+class LegacyCsvWriter:
+    #opt-in data_out.csv with one row per packet, same layout the display always wrote
+    def __init__(self, path, data_streams, max_pending_batches=256):
+        self.field_names = [data_stream.name for data_stream in data_streams]
+        self.openfile = open(path, 'w', newline='')
+        self.csvwriter = csv.writer(self.openfile)
+
+        self.record_queue = queue.Queue(max_pending_batches) #bounded like FlightLogWriter's
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.start()
+
+    def write(self, records):
+        self.record_queue.put(records)
+
+    def writer_loop(self):
+        while True:
+            records = self.record_queue.get()
+            if records is None:
+                break
+            columns = [records[field_name].tolist() for field_name in self.field_names]
+            self.csvwriter.writerows(zip(*columns))
+        self.openfile.close()
+
+    def close(self):
+        self.record_queue.put(None)
+        self.writer_thread.join()
+
+
+def encode_header(header):
+    header_bytes = json.dumps(header).encode()
+    padding = -(len(MAGIC) + 4 + len(header_bytes)) % HEADER_ALIGNMENT
+    header_bytes += b' '*padding
+    return MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes
+
+def read_header(path):
+    #returns the header dict and the byte offset of the first record
+    with open(path, 'rb') as openfile:
+        if openfile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a flight log")
+        header_length, = struct.unpack('<I', openfile.read(4))
+        header = json.loads(openfile.read(header_length))
+    return header, len(MAGIC) + 4 + header_length
+
+def open_flight_log(path):
+    #memory mapped view of every record, nothing is read until it is indexed
+    header, offset = read_header(path)
+    record_dtype = dtype_from_json(header['record_dtype'])
+    return header, np.memmap(path, dtype=record_dtype, mode='r', offset=offset)
+
+def flat_columns(record_dtype):
+    #column names with vector fields expanded, e.g. 'Quat Data[0]'
+    columns = []
+    for name in record_dtype.names:
+        shape = record_dtype.fields[name][0].shape
+        columns.extend([f'{name}[{i}]' for i in range(shape[0])] if shape else [name])
+    return columns
+
+def flatten_records(records):
+    #(N, n_columns) float array in flat_columns order
+    return np.column_stack([records[name].reshape(len(records), -1) for name in records.dtype.names])
+
+def export_csv(path, csv_path, chunk_records=65536):
+    header, records = open_flight_log(path)
+    columns = flat_columns(records.dtype)
+    column_formats = ['%.6f' if column == 'timestamp' else '%.9g' for column in columns]
+    with open(csv_path, 'w', newline='') as openfile:
+        openfile.write(','.join(columns) + '\n')
+        for start in range(0, len(records), chunk_records):
+            np.savetxt(openfile, flatten_records(records[start:start+chunk_records]), delimiter=',', fmt=column_formats)
+
+def export_npy(path, npy_path):
+    header, records = open_flight_log(path)
+    np.save(npy_path, np.asarray(records))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert a binary flight log')
+    parser.add_argument('log_path')
+    parser.add_argument('--csv', dest='csv_path')
+    parser.add_argument('--npy', dest='npy_path')
+    args = parser.parse_args()
+
+    header, records = open_flight_log(args.log_path)
+    print(f"{len(records)} records, streams: {', '.join(stream['name'] for stream in header['streams'])}")
+    if args.csv_path:
+        export_csv(args.log_path, args.csv_path)
+    if args.npy_path:
+        export_npy(args.log_path, args.npy_path)
@@ -0,0 +1,368 @@
+import collections
+import json
+import os
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from flight_log import MAGIC, encode_header
+from frame_schema import dtype_from_json
+
+#fan-out of decoded records to other processes/machines over TCP or unix sockets
+#stream layout: the flight log header (MAGIC, uint32 length, json schema), then batches of
+#BATCH_HEADER (records in the batch, records this client missed since the previous batch) + packed records
+#every client has its own bounded backlog. a client that falls behind loses its oldest batches, the reader never waits
+BATCH_HEADER = struct.Struct('<II')
+
+
+def parse_address(text):
+    #'unix:/tmp/imu.sock' -> path, 'host:port' -> (host, port), 'port' -> ('127.0.0.1', port)
+    if text.startswith('unix:'):
+        return text[len('unix:'):]
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def make_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+def read_exactly(sock, n_bytes):
+    data = bytearray()
+    while len(data) < n_bytes:
+        chunk = sock.recv(n_bytes - len(data))
+        if not chunk:
+            raise ConnectionError('publisher closed the connection')
+        data += chunk
+    return bytes(data)
+
+def read_stream_header(sock):
+    if read_exactly(sock, len(MAGIC)) != MAGIC:
+        raise ValueError('not a frame publisher stream')
+    header_length, = struct.unpack('<I', read_exactly(sock, 4))
+    return json.loads(read_exactly(sock, header_length))
+
+def fetch_header(address, timeout=5):
+    #schema of a running publisher, e.g. to build the data_streams of a remote viewer
+    with make_socket(address) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        return read_stream_header(sock)
+
+def streams_from_header(header):
+    #data stream objects for the schema in a publisher (or flight log) header
+    import user_serial_data_classes
+    return [getattr(user_serial_data_classes, stream['type'])(stream['name'], stream['display'], stream['format'], stream['dsize'])
+            for stream in header['streams']]
+
+
+class PublisherClient:
+    def __init__(self, header, max_pending_batches):
+        self.batches = collections.deque()
+        self.max_pending_batches = max_pending_batches
+        self.outgoing = memoryview(header) #bytes of the message being sent, the schema header first
+        self.missed_records = 0 #dropped since the last batch that was sent, reported in the next batch header
+        self.dropped_records = 0
+
+    def queue_batch(self, n_records, payload):
+        if len(self.batches) == self.max_pending_batches:
+            dropped_records, _ = self.batches.popleft()
+            self.missed_records += dropped_records
+            self.dropped_records += dropped_records
+        self.batches.append((n_records, payload))
+
+    def pending(self):
+        return len(self.outgoing) > 0 or len(self.batches) > 0
+
+    def send(self, sock):
+        #sends until the socket buffer is full. raises BlockingIOError then, the rest goes on the next writable event
+        while self.pending():
+            if not len(self.outgoing):
+                n_records, payload = self.batches.popleft()
+                self.outgoing = memoryview(BATCH_HEADER.pack(n_records, self.missed_records) + payload)
+                self.missed_records = 0
+            self.outgoing = self.outgoing[sock.send(self.outgoing):]
+
+
+class FramePublisher:
+    #same write/close interface as the log writers, so it is fed the batches the data handler copies out of the ring
+    def __init__(self, address, frame_schema, max_pending_batches=64):
+        self.header = encode_header({**frame_schema.describe(), 'created':time.time()})
+        self.max_pending_batches = max_pending_batches
+        self.listen_socket = make_socket(address)
+        if isinstance(address, str):
+            if os.path.exists(address): #left over from a previous run
+                os.unlink(address)
+        else:
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(address)
+        self.listen_socket.listen()
+        self.listen_socket.setblocking(False)
+        self.address = self.listen_socket.getsockname() #the real port when bound to port 0
+
+        self.clients = {}
+        self.dropped_records = 0 #over all clients, including ones that disconnected
+        self.record_queue = queue.SimpleQueue()
+        self.wakeup_receive, self.wakeup_send = socket.socketpair()
+        self.wakeup_receive.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.publisher_thread = threading.Thread(target=self.publish_loop, daemon=True)
+        self.publisher_thread.start()
+
+    def write(self, records):
+        #never blocks: the batch is handed to the publisher thread
+        self.record_queue.put(records)
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError: #wakeup already pending
+            pass
+
+    def close(self):
+        self.write(None)
+        self.publisher_thread.join()
+
+    def publish_loop(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listen_socket, selectors.EVENT_READ, 'accept')
+        selector.register(self.wakeup_receive, selectors.EVENT_READ, 'wakeup')
+        running = True
+        while running:
+            for key, events in selector.select():
+                if key.data == 'accept':
+                    client_socket, _ = self.listen_socket.accept()
+                    client_socket.setblocking(False)
+                    self.clients[client_socket] = PublisherClient(self.header, self.max_pending_batches)
+                    selector.register(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self.clients[client_socket])
+                elif key.data == 'wakeup':
+                    try:
+                        while self.wakeup_receive.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while running and not self.record_queue.empty():
+                        records = self.record_queue.get()
+                        if records is None:
+                            running = False
+                            break
+                        payload = records.tobytes() #packed once, shared by every client
+                        for client_socket, client in self.clients.items():
+                            client.queue_batch(len(records), payload)
+                            selector.modify(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+                else:
+                    self.service_client(selector, key.fileobj, key.data, events)
+        for client_socket in list(self.clients):
+            self.drop_client(selector, client_socket)
+        selector.close()
+        self.listen_socket.close()
+        if isinstance(self.address, str):
+            os.unlink(self.address)
+        self.wakeup_receive.close()
+        self.wakeup_send.close()
+
+    def service_client(self, selector, client_socket, client, events):
+        if client_socket not in self.clients: #dropped earlier in the same select round
+            return
+        try:
+            if events & selectors.EVENT_READ and not client_socket.recv(4096): #clients never send, readable means closed
+                self.drop_client(selector, client_socket)
+                return
+            if events & selectors.EVENT_WRITE:
+                client.send(client_socket)
+                selector.modify(client_socket, selectors.EVENT_READ, client) #all sent, wait for the next batch
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop_client(selector, client_socket)
+
+    def drop_client(self, selector, client_socket):
+        client = self.clients.pop(client_socket)
+        self.dropped_records += client.dropped_records
+        selector.unregister(client_socket)
+        client_socket.close()
+
+    def client_count(self):
+        return len(self.clients)
+
+
+class SubscriberSource:
+    #source for SerialRead that reads a publisher's stream instead of a serial port, for remote viewers
+    def __init__(self, address, timeout=5):
+        self.address = address
+        self.timeout = timeout
+
+    def open(self):
+        return SubscriberConnection(self.address, self.timeout)
+
+    def make_parser(self, record_dtype, protocol=1, max_frames=64):
+        return RecordStreamParser(record_dtype)
+
+
+class SubscriberConnection:
+    #just enough of the pyserial interface for SerialRead. reconnects when the publisher goes away
+    def __init__(self, address, timeout):
+        self.address = address
+        self._timeout = timeout
+        self.socket = None
+        self.header = None
+        self.generation = 0 #bumped on every new connection, the parser drops partial batches from the old one
+        self.bytes_received = 0
+        self.connect()
+
+    def connect(self):
+        sock = make_socket(self.address)
+        try:
+            sock.settimeout(self._timeout)
+            sock.connect(self.address)
+            self.header = read_stream_header(sock)
+        except (OSError, ValueError):
+            sock.close()
+            return
+        self.socket = sock
+        self.generation += 1
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+        if self.socket is not None:
+            self.socket.settimeout(timeout)
+
+    @property
+    def in_waiting(self):
+        return 65536 #recv returns whatever has arrived, this only caps the read size
+
+    def readinto(self, buffer):
+        if self.socket is None:
+            time.sleep(self._timeout) #publisher not there (yet), try again like a quiet port would time out
+            self.connect()
+            return 0
+        try:
+            n_bytes = self.socket.recv_into(buffer)
+        except socket.timeout:
+            return 0
+        except OSError:
+            n_bytes = 0
+        if n_bytes == 0: #publisher closed
+            self.socket.close()
+            self.socket = None
+        self.bytes_received += n_bytes
+        return n_bytes
+
+    def read(self, size=1):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def reset_input_buffer(self):
+        #the backlog sits in the publisher, a fresh connection starts at the newest batches
+        if self.bytes_received:
+            self.close()
+            self.bytes_received = 0
+            self.connect()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class RecordStreamParser:
+    #FrameParser counterpart for the publisher stream. records keep the timestamps they were given by the publishing reader
+    def __init__(self, record_dtype, chunk_size=65536):
+        self.record_dtype = record_dtype
+        self.chunk = bytearray(chunk_size)
+        self.chunk_view = memoryview(self.chunk)
+        self.pending = bytearray()
+        self.generation = None
+        self.remote_dtype = None
+
+        #same counters as FrameParser. dropped_frames are the records the publisher dropped for this client
+        self.resyncs = 0
+        self.crc_errors = 0
+        self.dropped_frames = 0
+
+    def read_from(self, connection, n_bytes):
+        if connection.generation != self.generation:
+            self.pending.clear()
+            self.generation = connection.generation
+            if connection.header is not None:
+                self.remote_dtype = dtype_from_json(connection.header['record_dtype'])
+                self.shared_fields = [name for name in self.record_dtype.names if name in self.remote_dtype.names]
+        n_read = connection.readinto(self.chunk_view[:min(n_bytes, len(self.chunk))])
+        self.pending += self.chunk_view[:n_read]
+        return n_read
+
+    def parse(self, timestamp=0.0):
+        batches = [] #(offset, n_records) of every complete batch
+        position = 0
+        while len(self.pending) - position >= BATCH_HEADER.size:
+            n_records, missed_records = BATCH_HEADER.unpack_from(self.pending, position)
+            batch_size = n_records*self.remote_dtype.itemsize
+            if len(self.pending) - position - BATCH_HEADER.size < batch_size:
+                break
+            batches.append((position + BATCH_HEADER.size, n_records))
+            self.dropped_frames += missed_records
+            position += BATCH_HEADER.size + batch_size
+        if not batches: #the read ended inside a batch, the rest comes with the next reads
+            return np.zeros(0, dtype=self.record_dtype)
+
+        #only the fields both sides know are kept, e.g. a merged stream's device column is dropped
+        records = np.zeros(sum(n_records for _, n_records in batches), dtype=self.record_dtype)
+        start = 0
+        for offset, n_records in batches:
+            remote_records = np.frombuffer(self.pending, dtype=self.remote_dtype, count=n_records, offset=offset)
+            records[self.shared_fields][start:start+n_records] = remote_records[self.shared_fields]
+            start += n_records
+        del remote_records #the buffer can only be resized once no view of it is left
+        del self.pending[:position]
+        return records
+
+
+def loopback_check(n_batches=100, max_read=97, seed=0, timeout=10):
+    #publishes random batches to a subscriber on 127.0.0.1 and reads them back in small random reads, so batch headers and
+    #records are split across reads like TCP segments on a real network. one batch is bigger than the parser's 64 KiB chunk.
+    #raises AssertionError when what arrives differs from what was published
+    from frame_schema import FrameSchema
+    from user_serial_data_classes import imu_data_streams
+    rng = np.random.default_rng(seed)
+    frame_schema = FrameSchema(imu_data_streams())
+    publisher = FramePublisher(('127.0.0.1', 0), frame_schema)
+    connection = SubscriberConnection(publisher.address, timeout=0.1)
+    try:
+        deadline = time.perf_counter() + timeout
+        while publisher.client_count() == 0: #batches written before the accept would not reach this client
+            assert time.perf_counter() < deadline, 'subscriber was not accepted'
+            time.sleep(0.01)
+        published = []
+        for batch_size in [*rng.integers(1, 300, n_batches), 4000]:
+            records = np.zeros(batch_size, dtype=frame_schema.record_dtype)
+            for name in frame_schema.record_dtype.names:
+                records[name] = rng.normal(size=records[name].shape)
+            publisher.write(records)
+            published.append(records)
+        published = np.concatenate(published)
+
+        parser = RecordStreamParser(frame_schema.record_dtype)
+        received = []
+        n_received = 0
+        while n_received < len(published):
+            assert time.perf_counter() < deadline, f'received {n_received} of {len(published)} records'
+            parser.read_from(connection, int(rng.integers(1, max_read)))
+            records = parser.parse()
+            received.append(records)
+            n_received += len(records)
+        received = np.concatenate(received)
+        assert parser.dropped_frames == 0 and np.array_equal(received, published), 'records differ'
+        return received
+    finally:
+        connection.close()
+        publisher.close()
+
+
+if __name__=='__main__':
+    n_records = len(loopback_check())
+    print(f'loopback check passed, {n_records} records split across reads')
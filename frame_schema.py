@@ -0,0 +1,196 @@
+import struct
+from binascii import crc_hqx
+import numpy as np
+
+#protocol 1: sync pattern + packet, checked by the sync pattern of the next packet
+#protocol 2: sync pattern + uint16 payload length + uint16 sequence counter + packet + uint16 CRC-16/CCITT (init 0xFFFF)
+#            over length, sequence and packet. see PROTOCOL_VERSION in the arduino sketch
+SYNC_PATTERN = b'\x00\xff\x00\xff'
+CRC_INIT = 0xFFFF
+
+
+class FrameSchema:
+    #compiles the ordered data_streams list into one packed frame layout
+    def __init__(self, data_streams, sync_pattern=SYNC_PATTERN, byte_order='<', extra_fields=(), derived_channels=(), derived_streams=()):
+        self.data_streams = data_streams
+        self.sync_pattern = sync_pattern
+        self.derived_channels = list(derived_channels) #see derived_channels, computed by the reader after decoding
+        #derived_streams: streams of derived channels computed elsewhere, e.g. they arrive computed from a frame publisher
+
+        payload_format = byte_order
+        record_fields = []
+        expected_size = 0
+        for data_stream in data_streams:
+            payload_format += data_stream.dtype_format_specifier * data_stream.n_values
+            record_fields.append(self.stream_field(data_stream, byte_order))
+            expected_size += data_stream.dsize * data_stream.n_values
+
+        self.payload_struct = struct.Struct(payload_format)
+        if self.payload_struct.size != expected_size:
+            raise ValueError(f"Packed payload size {self.payload_struct.size} does not match stream dsize total {expected_size}")
+        self.payload_size = self.payload_struct.size
+
+        #record_dtype is what the rest of the app stores (arrival timestamp + streams + derived channels)
+        #extra_fields are record-only columns after the timestamp that never go over the wire, e.g. the device index of merged streams
+        self.extra_fields = list(extra_fields)
+        self.derived_streams = [channel.data_stream for channel in self.derived_channels] + list(derived_streams)
+        derived_fields = [self.stream_field(data_stream, byte_order) for data_stream in self.derived_streams]
+        self.record_dtype = np.dtype([('timestamp', '<f8')] + self.extra_fields + record_fields + derived_fields)
+        self.field_names = [data_stream.name for data_stream in data_streams] #wire fields only
+        self.all_streams = list(data_streams) + self.derived_streams #what gets logged and plotted
+
+    def stream_field(self, data_stream, byte_order='<'):
+        field_format = byte_order + data_stream.dtype_format_specifier
+        if data_stream.n_values == 1:
+            return (data_stream.name, field_format)
+        return (data_stream.name, field_format, (data_stream.n_values,))
+
+    def describe(self):
+        #json friendly description of the schema, stored in log file headers
+        return {
+            'streams':[{
+                'name':data_stream.name,
+                'type':type(data_stream).__name__,
+                'display':data_stream.display,
+                'format':data_stream.dtype_format_specifier,
+                'dsize':data_stream.dsize,
+                'n_values':data_stream.n_values,
+                'derived':data_stream in self.derived_streams
+            } for data_stream in self.all_streams],
+            'record_dtype':dtype_to_json(self.record_dtype)
+        }
+
+
+class FrameParser:
+    #buffered frame parser. bytes are read into a preallocated buffer, frames are decoded in bulk with np.frombuffer
+    #and lost sync is recovered by scanning the bytes already received with bytes.find, no sleeping or single byte reads
+    def __init__(self, record_dtype, protocol=1, sync_pattern=SYNC_PATTERN, max_frames=64, field_names=None):
+        self.record_dtype = record_dtype
+        self.protocol = protocol
+        self.sync_pattern = sync_pattern
+        #fields that come over the wire (FrameSchema.field_names), the other record fields are left for later stages
+        self.field_names = field_names if field_names is not None else [name for name in record_dtype.names if name != 'timestamp']
+        self.packet_dtype = packet_dtype(record_dtype, protocol, sync_pattern, self.field_names)
+        self.packet_size = self.packet_dtype.itemsize
+        self.payload_size = self.packet_size - packet_overhead(protocol, sync_pattern)
+
+        self.buffer = bytearray(self.packet_size*(max_frames + 2))
+        self.buffer_view = memoryview(self.buffer)
+        self.fill = 0
+        self.last_sequence = None
+
+        #exact counters, read by SerialRead after every parse
+        self.resyncs = 0
+        self.crc_errors = 0
+        self.dropped_frames = 0
+
+    def free_space(self):
+        return len(self.buffer) - self.fill
+
+    def read_from(self, serial_connection, n_bytes):
+        n_bytes = min(n_bytes, self.free_space())
+        n_read = serial_connection.readinto(self.buffer_view[self.fill:self.fill+n_bytes])
+        self.fill += n_read
+        return n_read
+
+    def parse(self, timestamp=0.0):
+        #returns stamped records for every complete valid frame in the buffer, keeps partial frames for the next call
+        decoded = []
+        position = 0
+        while True:
+            sync_index = self.buffer.find(self.sync_pattern, position, self.fill)
+            if sync_index < 0:
+                position = max(position, self.fill - len(self.sync_pattern) + 1) #a sync pattern may be split over reads
+                break
+            if sync_index != position:
+                self.resyncs += 1
+            n_frames = (self.fill - sync_index)//self.packet_size
+            if n_frames == 0:
+                position = sync_index
+                break
+            frames = np.frombuffer(self.buffer, dtype=self.packet_dtype, count=n_frames, offset=sync_index)
+            n_valid, waiting = self.valid_frames(frames, sync_index)
+            if n_valid:
+                decoded.append(frames[:n_valid])
+            position = sync_index + n_valid*self.packet_size
+            if waiting:
+                break
+            position += 1 #frame at position is bad, hunt for the next sync pattern after it
+
+        n_records = sum(len(frames) for frames in decoded)
+        records = np.empty(n_records, dtype=self.record_dtype)
+        records['timestamp'] = timestamp
+        if n_records:
+            frames = decoded[0] if len(decoded) == 1 else np.concatenate(decoded)
+            records[self.field_names] = frames[self.field_names]
+        #decoded frames are views of the buffer, so only move the leftover bytes to the front once they are copied
+        self.buffer[:self.fill-position] = self.buffer_view[position:self.fill]
+        self.fill -= position
+        return records
+
+    def valid_frames(self, frames, sync_index):
+        #number of leading good frames, and whether the next one only needs more bytes to be checked
+        n_frames = len(frames)
+        sync_ok = frames['sync'] == self.sync_pattern
+        if self.protocol == 1:
+            #a v1 frame is trusted once the sync pattern of the following frame has arrived too
+            trailing_start = sync_index + n_frames*self.packet_size
+            trailing_available = self.fill - trailing_start >= len(self.sync_pattern)
+            trailing_ok = trailing_available and self.buffer[trailing_start:trailing_start+len(self.sync_pattern)] == self.sync_pattern
+            good = sync_ok & np.append(sync_ok[1:], trailing_ok)
+            n_valid = n_frames if good.all() else int(np.argmin(good))
+            waiting = n_valid == n_frames or (n_valid == n_frames - 1 and sync_ok[n_valid] and not trailing_available)
+            return n_valid, waiting
+
+        good = sync_ok & (frames['length'] == self.payload_size)
+        n_valid = n_frames if good.all() else int(np.argmin(good))
+        crc_start = sync_index + len(self.sync_pattern)
+        for i in range(n_valid):
+            frame_start = crc_start + i*self.packet_size
+            if crc_hqx(self.buffer_view[frame_start:frame_start+self.packet_size-len(self.sync_pattern)-2], CRC_INIT) != frames['crc'][i]:
+                self.crc_errors += 1
+                n_valid = i
+                break
+        if n_valid:
+            self.count_sequence_gaps(frames['sequence'][:n_valid])
+        return n_valid, n_valid == n_frames
+
+    def count_sequence_gaps(self, sequences):
+        sequences = sequences.astype(np.int64)
+        if self.last_sequence is not None:
+            sequences = np.concatenate(([self.last_sequence], sequences))
+        self.dropped_frames += int(((np.diff(sequences) - 1) % 65536).sum())
+        self.last_sequence = int(sequences[-1])
+
+
+def packet_overhead(protocol, sync_pattern=SYNC_PATTERN):
+    return len(sync_pattern) + (6 if protocol == 2 else 0)
+
+def packet_dtype(record_dtype, protocol=1, sync_pattern=SYNC_PATTERN, field_names=None):
+    #wire layout of one packet for the streams in record_dtype, or only field_names of them
+    stream_fields = [field for field in dtype_to_json(record_dtype) if field[0] != 'timestamp' and (field_names is None or field[0] in field_names)]
+    header_fields = [['sync', f'|S{len(sync_pattern)}', []]]
+    trailer_fields = []
+    if protocol == 2:
+        header_fields += [['length', '<u2', []], ['sequence', '<u2', []]]
+        trailer_fields = [['crc', '<u2', []]]
+    return dtype_from_json(header_fields + stream_fields + trailer_fields)
+
+def encode_packets(records, protocol=1, first_sequence=0, sync_pattern=SYNC_PATTERN):
+    #records back into the bytes the arduino sketch would send
+    packets = np.empty(len(records), dtype=packet_dtype(records.dtype, protocol, sync_pattern))
+    field_names = [name for name in records.dtype.names if name != 'timestamp']
+    packets['sync'] = sync_pattern
+    packets[field_names] = records[field_names]
+    if protocol == 2:
+        packets['length'] = packets.dtype.itemsize - packet_overhead(protocol, sync_pattern)
+        packets['sequence'] = (first_sequence + np.arange(len(records))) % 65536
+        packet_bytes = packets.view(np.uint8).reshape(len(records), -1)
+        packets['crc'] = [crc_hqx(packet[len(sync_pattern):-2].tobytes(), CRC_INIT) for packet in packet_bytes]
+    return packets.tobytes()
+
+def dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+def dtype_from_json(fields):
+    return np.dtype([(name, field_format, tuple(shape)) if shape else (name, field_format) for name, field_format, shape in fields])
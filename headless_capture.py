@@ -0,0 +1,197 @@
+import time
+START_TIME = time.perf_counter() #for --report-startup, taken before anything else is imported
+import argparse
+import json
+import sys
+from frame_schema import FrameSchema
+from shared_ring_buffer import SharedRingBuffer, BLOCK
+from serial_reading_handler import SerialRead
+from multi_device import DeviceConfig, MultiDeviceRead, merged_schema
+from serial_sources import SerialPortSource, ReplaySource, SyntheticSource, PtySource
+from flight_log import FlightLogWriter, LegacyCsvWriter
+from perf_counters import pipeline_counters, PerfMonitor, memory_usage
+from frame_publisher import FramePublisher, SubscriberSource, parse_address, fetch_header, streams_from_header
+from user_serial_data_classes import imu_data_streams, imu_derived_channels
+from trigger_capture import TriggerCapture, parse_trigger
+from session_store import SessionWriter
+
+#capture-only entry point: SerialRead plus logging, no Qt, OpenGL or pyqtgraph is imported
+#python headless_capture.py --port COM3 --log flight.imulog --duration 600
+#flight_display_child.py builds its reader through the same helpers, so both modes accept the same source options
+BUFFER_POLICIES = ['block', 'drop-oldest', 'drop-newest', 'decimate']
+
+
+def add_capture_arguments(parser):
+    parser.add_argument('--port', nargs='+', default=['COM3'], help='one or more ports, each is read by its own process and merged by arrival time')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--replay', metavar='LOG_PATH', help='replay a recorded flight log instead of opening the port')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier, 0 for as fast as possible')
+    parser.add_argument('--synthetic', type=float, metavar='RATE_HZ', help='generate packets at this rate, 0 for as fast as possible')
+    parser.add_argument('--noise', type=float, default=0.01, help='synthetic noise standard deviation')
+    parser.add_argument('--pty', action='store_true', help='feed replay/synthetic bytes through a pseudo terminal (linux)')
+    parser.add_argument('--protocol', type=int, choices=[1, 2], default=1, help='2 if the sketch is built with PROTOCOL_VERSION 2')
+    parser.add_argument('--subscribe', metavar='ADDRESS', help='view/log the frames of another capture\'s --publish (HOST:PORT or unix:PATH) instead of a port')
+    parser.add_argument('--derived', action='store_true', help='compute, log and plot the derived channels of imu_derived_channels (magnitudes, filters, gyro orientation)')
+    parser.add_argument('--publish', metavar='ADDRESS', help='serve decoded frames to subscribers on HOST:PORT or unix:PATH')
+    parser.add_argument('--sample-rate', type=float, default=100.0, help='nominal sensor sample rate in Hz, for trigger windows, the spectrum frequency axis and the derived filters and gyro integration')
+    parser.add_argument('--trigger', action='append', metavar='STREAM:KIND:VALUE', help="write a burst file around every event, e.g. 'Accel Z:above:15', 'Gyro X:rate:500', 'Euler Data[2]:rising:0' (kinds: above, below, rising, falling, rate). repeat for more conditions")
+    parser.add_argument('--pre-trigger', type=float, default=1.0, help='seconds kept before a trigger')
+    parser.add_argument('--post-trigger', type=float, default=2.0, help='seconds written after the last trigger of a burst')
+    parser.add_argument('--burst-prefix', default='burst', help='burst files are PREFIX_0001.imulog..., events go to PREFIX_events.jsonl')
+    parser.add_argument('--session', metavar='DIR', help='also store the capture as memory mapped columns with a time index for post-flight queries (session_store.py)')
+    parser.add_argument('--log', default='data_out.imulog', help='flight log path')
+    parser.add_argument('--legacy-csv', metavar='PATH', help='also write the old csv log, e.g. data_out.csv')
+    parser.add_argument('--no-log', action='store_true', help='no continuous flight log, e.g. only trigger bursts')
+    parser.add_argument('--buffer-policy', choices=BUFFER_POLICIES, default='drop-newest',
+                        help='when the logger/display falls behind the reader: block the reader (lossless), drop the oldest or the newest frames, or decimate only what is drawn while logging everything. display drops and decimation shorten the strip chart x axis, which counts drawn samples')
+    parser.add_argument('--ring-capacity', type=int, default=16384, help='frames buffered between the reader and the logger/display')
+    parser.add_argument('--perf-log', metavar='PATH', help='append pipeline counters to this json lines file every second')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    parser.add_argument('--report-startup', action='store_true', help='print startup time and peak memory as json on exit')
+
+def ring_policy(buffer_policy):
+    #decimating is a display policy, the ring under it must not lose anything
+    return BLOCK if buffer_policy == 'decimate' else buffer_policy
+
+def make_ring(args, frame_schema):
+    return SharedRingBuffer(frame_schema.record_dtype, args.ring_capacity, policy=ring_policy(args.buffer_policy))
+
+def make_source(args, port, data_streams, timeout=5):
+    if args.replay:
+        source = ReplaySource(args.replay, speed=args.speed, timeout=timeout, protocol=args.protocol)
+    elif args.synthetic is not None:
+        source = SyntheticSource(data_streams, rate_hz=args.synthetic, noise=args.noise, timeout=timeout, protocol=args.protocol)
+    else:
+        source = SerialPortSource(port, args.baudrate, timeout)
+    if args.pty and not isinstance(source, SerialPortSource):
+        source = PtySource(source, args.baudrate)
+    return source
+
+def start_capture(args, timeout=5):
+    #starts the reader process(es) for args.port. returns data_streams, frame_schema, data_ring, perf_counters, serial_reader
+    #data_streams are the streams to log and plot, derived channels included
+    if args.subscribe:
+        #the schema comes from the publisher, frames are already decoded and keep their original timestamps
+        address = parse_address(args.subscribe)
+        header = fetch_header(address, timeout)
+        header_streams = streams_from_header(header)
+        #derived channels arrive computed, their streams are declared apart from the wire streams so the log header keeps the flag
+        raw_streams = [data_stream for data_stream, stream in zip(header_streams, header['streams']) if not stream.get('derived', False)]
+        derived_streams = [data_stream for data_stream, stream in zip(header_streams, header['streams']) if stream.get('derived', False)]
+        frame_schema = FrameSchema(raw_streams, derived_streams=derived_streams)
+        data_streams = frame_schema.all_streams
+        data_ring = make_ring(args, frame_schema)
+        perf_counters = pipeline_counters(data_streams)
+        serial_reader = SerialRead(None, None, timeout, data_streams, data_ring, source=SubscriberSource(address, timeout), perf_counters=perf_counters)
+    elif len(args.port) == 1:
+        port = args.port[0]
+        raw_streams = imu_data_streams()
+        derived_channels = imu_derived_channels(sample_rate_hz=args.sample_rate) if args.derived else []
+        frame_schema = FrameSchema(raw_streams, derived_channels=derived_channels)
+        data_streams = frame_schema.all_streams
+        data_ring = make_ring(args, frame_schema)
+        perf_counters = pipeline_counters(data_streams)
+        serial_reader = SerialRead(port, args.baudrate, timeout, raw_streams, data_ring, source=make_source(args, port, raw_streams, timeout), perf_counters=perf_counters,
+                                   protocol=args.protocol, derived_channels=derived_channels)
+    else:
+        #one reader process per port plus a merger process, streams are prefixed with the port name and share the plots
+        devices = []
+        for port in args.port:
+            device_streams = imu_data_streams(f'{port} ')
+            derived_channels = imu_derived_channels(f'{port} ', args.sample_rate) if args.derived else []
+            devices.append(DeviceConfig(port, device_streams, make_source(args, port, device_streams, timeout), port, args.baudrate, timeout, args.protocol, derived_channels=derived_channels))
+        frame_schema = merged_schema(devices)
+        data_streams = frame_schema.all_streams
+        data_ring = make_ring(args, frame_schema)
+        perf_counters = pipeline_counters(data_streams)
+        serial_reader = MultiDeviceRead(devices, data_ring, perf_counters)
+    return data_streams, frame_schema, data_ring, perf_counters, serial_reader
+
+def make_sinks(args, frame_schema):
+    #writers fed the same batches as the flight log
+    sinks = [FramePublisher(parse_address(args.publish), frame_schema)] if args.publish else []
+    if args.session:
+        sinks.append(SessionWriter(args.session, frame_schema))
+    return sinks
+
+def make_trigger_capture(args, frame_schema):
+    #also a sink. FlightDisplay additionally takes it as the source of its strip chart markers
+    if not args.trigger:
+        return None
+    conditions = [parse_trigger(text, args.sample_rate) for text in args.trigger]
+    return TriggerCapture(frame_schema, conditions, args.burst_prefix, args.pre_trigger, args.post_trigger, args.sample_rate)
+
+def startup_report(mode, start_time, ready_time, first_record_time):
+    #times are seconds after START_TIME of the entry script. memory is read after the readers are joined
+    return {
+        'mode':mode,
+        'ready_s':ready_time - start_time, #imports done and readers started
+        'first_record_s':None if first_record_time is None else first_record_time - start_time,
+        **memory_usage(),
+        'qt_loaded':'PyQt5' in sys.modules,
+        'pyqtgraph_loaded':'pyqtgraph' in sys.modules,
+        'opengl_loaded':'OpenGL' in sys.modules
+    }
+
+def capture(data_streams, frame_schema, data_ring, perf_counters, serial_reader, log_path, legacy_csv_path=None, duration=None, perf_log_path=None, sinks=()):
+    #logs until duration passes or ctrl+c. returns the perf_counter time of the first logged record
+    log_writers = [FlightLogWriter(log_path, frame_schema)] if log_path else []
+    if legacy_csv_path:
+        log_writers.append(LegacyCsvWriter(legacy_csv_path, data_streams))
+    log_writers.extend(sinks)
+    perf_monitor = PerfMonitor(perf_counters, perf_log_path)
+    first_record_time = None
+    stop_time = None if duration is None else time.perf_counter() + duration
+    next_status = time.perf_counter() + 1
+    try:
+        while stop_time is None or time.perf_counter() < stop_time:
+            if data_ring.wait(0.1):
+                write_start = time.perf_counter()
+                if first_record_time is None:
+                    first_record_time = write_start
+                perf_counters.set('handler_ring_depth', data_ring.available())
+                records = data_ring.read()
+                perf_counters.set('handler_ring_dropped_frames', data_ring.dropped_frames())
+                if len(records): #empty with drop-oldest when the reader wrote over everything while it was copied
+                    for log_writer in log_writers:
+                        log_writer.write(records)
+                    perf_counters.add('handler_batches')
+                    perf_counters.add('handler_records', len(records))
+                    perf_counters.add('handler_write_s', time.perf_counter() - write_start)
+            if time.perf_counter() >= next_status:
+                next_status += 1
+                stats = perf_monitor.sample()
+                print(f"decode {stats['decode_frames_per_s']:.0f} fr/s | logged {perf_counters.get('handler_records'):.0f} | ring {stats['ring_depth']:.0f}"
+                      f" | link drops {stats['link_dropped_frames']:.0f} | ring drops {stats['ring_dropped_frames']:.0f}, reader blocked {100*stats['reader_blocked']:.0f}% | cpu reader {100*stats['reader_cpu']:.0f}% logger {100*stats['gui_cpu']:.0f}%")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serial_reader.shutdown()
+        records = data_ring.read() #whatever the reader wrote before it stopped
+        for log_writer in log_writers:
+            if len(records):
+                log_writer.write(records)
+            log_writer.close()
+    return first_record_time
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Log IMU data without the display')
+    add_capture_arguments(parser)
+    args = parser.parse_args()
+
+    data_streams, frame_schema, data_ring, perf_counters, serial_reader = start_capture(args)
+    ready_time = time.perf_counter()
+    try:
+        trigger_capture = make_trigger_capture(args, frame_schema)
+    except ValueError: #e.g. a trigger on a stream that is not in the schema
+        serial_reader.shutdown()
+        data_ring.close()
+        raise
+    sinks = make_sinks(args, frame_schema)
+    if trigger_capture is not None:
+        sinks.append(trigger_capture)
+    first_record_time = capture(data_streams, frame_schema, data_ring, perf_counters, serial_reader, None if args.no_log else args.log, args.legacy_csv, args.duration, args.perf_log, sinks)
+    data_ring.close()
+    if args.report_startup:
+        print(json.dumps(startup_report('headless', START_TIME, ready_time, first_record_time)))
@@ -0,0 +1,97 @@
+import numpy as np
+
+#multi-resolution history for strip charts. level 0 is every sample, level n holds the min and max of branching**n samples,
+#so any window from a few samples to hours of data can be drawn with a couple of points per pixel and spikes stay visible
+
+
+class GrowableArray:
+    #append-only array with amortized doubling, the filled part is always one contiguous view
+    def __init__(self, dtype, capacity=1024):
+        self.storage = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        needed = self.size + len(values)
+        if needed > len(self.storage):
+            storage = np.empty(max(needed, 2*len(self.storage)), dtype=self.storage.dtype)
+            storage[:self.size] = self.storage[:self.size]
+            self.storage = storage
+        self.storage[self.size:needed] = values
+        self.size = needed
+
+    def view(self):
+        return self.storage[:self.size]
+
+
+class MinMaxHistory:
+    def __init__(self, dtype=np.float32, branching=4):
+        self.branching = branching
+        self.values = GrowableArray(dtype)
+        self.minimums = [] #level 1 and up, only complete buckets are stored
+        self.maximums = []
+
+    def __len__(self):
+        return self.values.size
+
+    def bucket_size(self, level):
+        return self.branching**level
+
+    def append(self, samples):
+        #incremental: every level only reduces the complete buckets that appeared since the last call
+        self.values.extend(samples)
+        level = 1
+        while True:
+            if level == 1:
+                lower_minimums = lower_maximums = self.values.view()
+            else:
+                lower_minimums, lower_maximums = self.minimums[level-2].view(), self.maximums[level-2].view()
+            if len(self.minimums) < level:
+                if len(lower_minimums) < self.branching:
+                    return
+                self.minimums.append(GrowableArray(self.values.storage.dtype))
+                self.maximums.append(GrowableArray(self.values.storage.dtype))
+            n_buckets = self.minimums[level-1].size
+            n_new = len(lower_minimums)//self.branching - n_buckets
+            if n_new <= 0:
+                return
+            start, end = n_buckets*self.branching, (n_buckets + n_new)*self.branching
+            self.minimums[level-1].extend(lower_minimums[start:end].reshape(n_new, self.branching).min(axis=1))
+            self.maximums[level-1].extend(lower_maximums[start:end].reshape(n_new, self.branching).max(axis=1))
+            level += 1
+
+    def query(self, x_start, x_end, n_pixels):
+        #(x, y) to draw sample indices x_start..x_end on n_pixels. coarse levels give min/max pairs at the bucket centre,
+        #the not yet complete buckets at the end are filled in from finer levels
+        x_start = max(int(np.floor(x_start)), 0)
+        x_end = min(int(np.ceil(x_end)) + 1, len(self))
+        if x_end <= x_start:
+            return np.empty(0), np.empty(0)
+        samples_per_pixel = (x_end - x_start)/max(n_pixels, 1)
+        #the finest level with at most one bucket per pixel, i.e. at most two points per pixel
+        level = 0
+        while level < len(self.minimums) and self.bucket_size(level) < samples_per_pixel:
+            level += 1
+        if level == 0:
+            return np.arange(x_start, x_end), self.values.view()[x_start:x_end]
+
+        x_parts, minimum_parts, maximum_parts = [], [], []
+        position = x_start
+        for current_level in range(level, 0, -1):
+            bucket_size = self.bucket_size(current_level)
+            first = position//bucket_size
+            last = min(-(-x_end//bucket_size), self.minimums[current_level-1].size)
+            if last > first:
+                x_parts.append((np.arange(first, last) + 0.5)*bucket_size - 0.5)
+                minimum_parts.append(self.minimums[current_level-1].view()[first:last])
+                maximum_parts.append(self.maximums[current_level-1].view()[first:last])
+                position = last*bucket_size
+            if position >= x_end:
+                break
+        if position < x_end:
+            raw = self.values.view()[position:x_end]
+            x_parts.append(np.arange(position, x_end))
+            minimum_parts.append(raw)
+            maximum_parts.append(raw)
+        x = np.repeat(np.concatenate(x_parts), 2)
+        y = np.column_stack((np.concatenate(minimum_parts), np.concatenate(maximum_parts))).ravel()
+        return x, y
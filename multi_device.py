@@ -0,0 +1,197 @@
+import multiprocessing as mp
+import time
+import numpy as np
+from frame_schema import FrameSchema
+from shared_ring_buffer import SharedRingBuffer
+from serial_reading_handler import SerialRead
+from serial_sources import SerialPortSource
+from perf_counters import PerfCounters, READER_COUNTERS, pipeline_counters
+
+#several IMUs at once: one SerialRead process per device, each filling its own ring with its own schema,
+#and one merger process that interleaves them by arrival timestamp into the single ring FlightDisplay reads
+
+
+class DeviceConfig:
+    def __init__(self, name, data_streams, source=None, port=None, baudrate=115200, timeout=5, protocol=1, ring_capacity=16384, derived_channels=()):
+        self.name = name
+        self.data_streams = data_streams #stream names must be unique across all devices, e.g. prefixed with the device name
+        self.derived_channels = list(derived_channels) #computed by the device's own reader, names must be unique too
+        self.source = source if source is not None else SerialPortSource(port, baudrate, timeout)
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.protocol = protocol
+        self.ring_capacity = ring_capacity
+
+
+def merged_schema(devices):
+    #every device's streams side by side, plus the index of the device each merged row came from
+    if len(devices) > 255:
+        raise ValueError(f"At most 255 devices can be merged, got {len(devices)}")
+    data_streams = [data_stream for device in devices for data_stream in device.data_streams]
+    derived_channels = [channel for device in devices for channel in device.derived_channels]
+    names = [data_stream.name for data_stream in data_streams] + [channel.name for channel in derived_channels]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Stream names must be unique across devices, duplicated: {duplicates}")
+    return FrameSchema(data_streams, extra_fields=[('device', 'u1')], derived_channels=derived_channels)
+
+
+class StreamMerger:
+    #k-way merge of the device rings by timestamp. a row is only emitted once every device has either delivered a later
+    #frame or been quiet for max_lag, so the merged stream stays time ordered without waiting forever on an idle device
+    def __init__(self, devices, device_rings, data_ring, data_event, perf_counters, device_counters, max_lag=0.05, merge_interval=0.005):
+        self.device_fields = [[data_stream.name for data_stream in FrameSchema(device.data_streams, derived_channels=device.derived_channels).all_streams] for device in devices]
+        self.device_rings = device_rings
+        self.data_event = data_event #shared by all device rings, set by whichever reader wrote last
+        self.stop_event = mp.Event()
+        self.perf_counters = perf_counters
+        self.device_counters = device_counters
+        self.max_lag = max_lag
+        self.merge_interval = merge_interval #readers write every few frames, merging every write would cost more than the merge itself
+
+        self.process = mp.Process(target=self.merging, args=(data_ring,))
+        self.process.start()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['process'] = None
+        return state
+
+    def shutdown(self, timeout=5):
+        if self.process is None or not self.process.is_alive():
+            return
+        self.stop_event.set()
+        self.data_event.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    #merger process
+    def merging(self, data_ring):
+        self.record_dtype = data_ring.record_dtype
+        self.held = [np.zeros(1, dtype=ring.record_dtype) for ring in self.device_rings] #last record of every device, for sample-and-hold
+        self.pending = [np.empty(0, dtype=ring.record_dtype) for ring in self.device_rings]
+        self.latest = [-np.inf]*len(self.device_rings)
+        self.emitted_until = -np.inf
+        while not self.stop_event.is_set():
+            if not any(ring.available() for ring in self.device_rings):
+                self.data_event.clear()
+                if not any(ring.available() for ring in self.device_rings): #written between the check and the clear
+                    self.data_event.wait(self.max_lag) #the timeout flushes rows held back for a device that went quiet
+            self.merge_available(data_ring)
+            self.stop_event.wait(self.merge_interval)
+        self.merge_available(data_ring, flush=True) #readers are already stopped, nothing earlier can arrive
+        print('Stream merging stopped')
+
+    def merge_available(self, data_ring, flush=False):
+        busy_start = time.perf_counter()
+        for i, ring in enumerate(self.device_rings):
+            if ring.available():
+                records = ring.read()
+                if not len(records): #drop-oldest: the reader wrote over everything while it was copied
+                    continue
+                self.pending[i] = np.concatenate((self.pending[i], records))
+                self.latest[i] = records['timestamp'][-1]
+        self.perf_counters.set('merge_ring_dropped_frames', sum(ring.dropped_frames() for ring in self.device_rings))
+
+        #everything up to the watermark is final: no device can still deliver an earlier arrival time
+        watermark = np.inf if flush else min(max(latest_timestamp, time.time() - self.max_lag) for latest_timestamp in self.latest)
+        batches = []
+        for i, pending in enumerate(self.pending):
+            n_records = int(np.searchsorted(pending['timestamp'], watermark, side='right'))
+            batches.append(pending[:n_records])
+            self.pending[i] = pending[n_records:]
+        n_records = sum(len(batch) for batch in batches)
+        if n_records:
+            merged = self.merge(batches)
+            n_late = int(np.count_nonzero(merged['timestamp'] < self.emitted_until))
+            if n_late: #a device delivered more than max_lag late, its rows are still logged but out of order
+                self.perf_counters.add('merge_late_frames', n_late)
+            self.emitted_until = max(self.emitted_until, merged['timestamp'][-1])
+            data_ring.write(merged, cancel=self.stop_event.is_set)
+            self.perf_counters.add('merge_frames', n_records)
+            self.perf_counters.add('merge_busy_s', time.perf_counter() - busy_start)
+        self.publish_reader_counters()
+
+    def merge(self, batches):
+        #stable sort keeps every device's own order and breaks timestamp ties by device index
+        device_index = np.concatenate([np.full(len(batch), i, dtype=np.uint8) for i, batch in enumerate(batches)])
+        timestamps = np.concatenate([batch['timestamp'] for batch in batches])
+        order = np.argsort(timestamps, kind='stable')
+        merged = np.empty(len(order), dtype=self.record_dtype)
+        merged['timestamp'] = timestamps[order]
+        merged['device'] = device_index[order]
+        for i, batch in enumerate(batches):
+            #row k of the merged batch holds the newest record of device i at or before it. held[0] is the one from earlier batches
+            held = np.concatenate((self.held[i], batch))
+            merged[self.device_fields[i]] = held[self.device_fields[i]][np.cumsum(merged['device'] == i)]
+            self.held[i] = held[-1:]
+        return merged
+
+    def publish_reader_counters(self):
+        #each reader has its own counters (one writer per slot), the merger is the only writer of the combined ones
+        totals = dict.fromkeys(READER_COUNTERS, 0.0)
+        for device_counters in self.device_counters:
+            for name, value in device_counters.snapshot().items():
+                totals[name] += value
+        totals['reader_cpu_s'] += time.process_time()
+        for name, value in totals.items():
+            self.perf_counters.set(name, value)
+
+
+class MultiDeviceRead:
+    #same control surface as SerialRead (start/stop/pause/resume/configure/shutdown) for a list of DeviceConfig
+    def __init__(self, devices, data_ring, perf_counters=None, max_lag=0.05, merge_interval=0.005, max_frames_per_read=64, poll_interval=0.05):
+        self.devices = devices
+        self.frame_schema = merged_schema(devices)
+        self.perf_counters = perf_counters if perf_counters is not None else pipeline_counters(self.frame_schema.all_streams)
+        self.poll_interval = poll_interval
+
+        data_event = mp.Event()
+        self.device_rings = []
+        self.device_counters = []
+        self.serial_readers = []
+        for device in devices:
+            #same policy as the merged ring, so a lossless (BLOCK) pipeline stays lossless through the merger
+            device_ring = SharedRingBuffer(FrameSchema(device.data_streams, derived_channels=device.derived_channels).record_dtype, device.ring_capacity, data_event=data_event, policy=data_ring.policy)
+            device_counters = PerfCounters(READER_COUNTERS)
+            self.serial_readers.append(SerialRead(device.port, device.baudrate, device.timeout, device.data_streams, device_ring,
+                                                  max_frames_per_read=max_frames_per_read, source=device.source, perf_counters=device_counters,
+                                                  protocol=device.protocol, poll_interval=poll_interval, derived_channels=device.derived_channels))
+            self.device_rings.append(device_ring)
+            self.device_counters.append(device_counters)
+        self.merger = StreamMerger(devices, self.device_rings, data_ring, data_event, self.perf_counters, self.device_counters, max_lag, merge_interval)
+
+    def device_reader(self, device_name):
+        return self.serial_readers[[device.name for device in self.devices].index(device_name)]
+
+    def start(self):
+        for serial_reader in self.serial_readers:
+            serial_reader.start()
+
+    def stop(self):
+        for serial_reader in self.serial_readers:
+            serial_reader.stop()
+
+    def pause(self):
+        for serial_reader in self.serial_readers:
+            serial_reader.pause()
+
+    def resume(self):
+        for serial_reader in self.serial_readers:
+            serial_reader.resume()
+
+    def configure(self, device_name, **options):
+        #e.g. configure('imu2', port='COM5')
+        self.device_reader(device_name).configure(**options)
+
+    def shutdown(self, timeout=5):
+        for serial_reader in self.serial_readers:
+            serial_reader.send('shutdown') #all readers wind down in parallel
+        for serial_reader in self.serial_readers:
+            serial_reader.shutdown(timeout)
+        self.merger.shutdown(timeout) #after the readers so the last frames are merged
+        for device_ring in self.device_rings:
+            device_ring.close()
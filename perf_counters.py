@@ -0,0 +1,132 @@
+import cProfile
+import json
+import multiprocessing as mp
+import sys
+import time
+
+#counters every pipeline stage updates. they live in shared memory so the reader process and the GUI process see the same values
+READER_COUNTERS = ['reader_bytes', 'reader_frames', 'reader_resyncs', 'reader_crc_errors', 'reader_dropped_frames', 'reader_busy_s', 'reader_derive_s', 'reader_blocked_s', 'reader_cpu_s']
+HANDLER_COUNTERS = ['handler_batches', 'handler_records', 'handler_ring_depth', 'handler_write_s', 'handler_spectrum_s', 'handler_ring_dropped_frames',
+                    'display_dropped_frames', 'display_decimated_frames', 'display_blocked_s']
+RENDER_COUNTERS = ['render_frames', 'render_s', 'render_late_frames', 'render_skipped_frames', 'render_over_budget_frames', 'render_degrade_level', 'render_views_s', 'display_lag_s', 'gui_cpu_s']
+MERGE_COUNTERS = ['merge_frames', 'merge_late_frames', 'merge_busy_s', 'merge_ring_dropped_frames'] #only moved when several devices are merged, see multi_device
+
+
+class PerfCounters:
+    #one float slot per name, no locks. each counter has a single writer so plain += is enough
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = {name:i for i, name in enumerate(self.names)}
+        self.values = mp.RawArray('d', len(self.names))
+
+    def add(self, name, amount=1):
+        self.values[self.index[name]] += amount
+
+    def set(self, name, value):
+        self.values[self.index[name]] = value
+
+    def get(self, name):
+        return self.values[self.index[name]]
+
+    def snapshot(self):
+        return dict(zip(self.names, self.values[:]))
+
+
+def pipeline_counters(data_streams):
+    #render time is also kept per stream ('render_s:<stream name>')
+    return PerfCounters(READER_COUNTERS + MERGE_COUNTERS + HANDLER_COUNTERS + RENDER_COUNTERS + [f'render_s:{data_stream.name}' for data_stream in data_streams])
+
+
+class PerfMonitor:
+    #turns periodic snapshots into rates for the status bar and an optional json lines export
+    def __init__(self, perf_counters, export_path=None):
+        self.perf_counters = perf_counters
+        self.export_path = export_path
+        self.previous = perf_counters.snapshot()
+        self.previous_time = time.perf_counter()
+
+    def sample(self):
+        self.perf_counters.set('gui_cpu_s', time.process_time()) #whole GUI process: data handler, log writers and rendering
+        current = self.perf_counters.snapshot()
+        now = time.perf_counter()
+        elapsed = max(now - self.previous_time, 1e-9)
+        delta = {name:current[name] - self.previous[name] for name in current}
+        self.previous, self.previous_time = current, now
+
+        render_frames = max(delta['render_frames'], 1)
+        stream_render_ms = {name.split(':', 1)[1]:1e3*value/render_frames for name, value in delta.items() if name.startswith('render_s:')}
+        stats = {
+            'time':time.time(),
+            'decode_frames_per_s':delta['reader_frames']/elapsed,
+            'read_bytes_per_s':delta['reader_bytes']/elapsed,
+            'reader_busy':delta['reader_busy_s']/elapsed,
+            'reader_cpu':delta['reader_cpu_s']/elapsed,
+            'reader_blocked':delta['reader_blocked_s']/elapsed,
+            'gui_cpu':delta['gui_cpu_s']/elapsed,
+            'resyncs':current['reader_resyncs'],
+            'crc_errors':current['reader_crc_errors'],
+            'link_dropped_frames':current['reader_dropped_frames'],
+            'ring_depth':current['handler_ring_depth'],
+            'ring_dropped_frames':current['handler_ring_dropped_frames'] + current['merge_ring_dropped_frames'], #merged ring plus the device rings
+            'display_dropped_frames':current['display_dropped_frames'],
+            'display_decimated_frames':current['display_decimated_frames'],
+            'display_lag_s':current['display_lag_s'],
+            'log_write_ms_per_batch':1e3*delta['handler_write_s']/max(delta['handler_batches'], 1),
+            'spectrum_ms_per_batch':1e3*delta['handler_spectrum_s']/max(delta['handler_batches'], 1),
+            'views_render_ms':1e3*delta['render_views_s']/render_frames,
+            'fps':delta['render_frames']/elapsed,
+            'render_ms':1e3*delta['render_s']/render_frames,
+            'late_frames':delta['render_late_frames'],
+            'skipped_frames':delta['render_skipped_frames'],
+            'over_budget_frames':delta['render_over_budget_frames'],
+            'degrade_level':current['render_degrade_level'],
+            'stream_render_ms':stream_render_ms
+        }
+        if self.export_path:
+            with open(self.export_path, 'a') as openfile:
+                openfile.write(json.dumps(stats) + '\n')
+        return stats
+
+    def status_text(self, stats):
+        slowest = max(stats['stream_render_ms'].items(), key=lambda item: item[1], default=('-', 0.0))
+        return (f"decode {stats['decode_frames_per_s']:.0f} fr/s | resyncs {stats['resyncs']:.0f} | crc errors {stats['crc_errors']:.0f}"
+                f" | link drops {stats['link_dropped_frames']:.0f} | ring {stats['ring_depth']:.0f}, drops {stats['ring_dropped_frames']:.0f}, reader blocked {100*stats['reader_blocked']:.0f}%"
+                f" | display drops {stats['display_dropped_frames']:.0f}, decimated {stats['display_decimated_frames']:.0f}, lag {stats['display_lag_s']:.2f} s"
+                f" | log {stats['log_write_ms_per_batch']:.2f} ms/batch | {stats['fps']:.0f} fps, {stats['render_ms']:.2f} ms/frame"
+                f" (late {stats['late_frames']:.0f}, skipped {stats['skipped_frames']:.0f}, over budget {stats['over_budget_frames']:.0f}, degrade {stats['degrade_level']:.0f})"
+                f" | slowest {slowest[0]} {slowest[1]:.2f} ms | cpu reader {100*stats['reader_cpu']:.0f}% gui {100*stats['gui_cpu']:.0f}%")
+
+
+class ProfilerToggle:
+    #cProfile of the calling thread that can be switched on and off at runtime. stats are dumped on every stop
+    def __init__(self, output_prefix='profile'):
+        self.output_prefix = output_prefix
+        self.profiler = None
+
+    def toggle(self):
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return None
+        self.profiler.disable()
+        output_path = f'{self.output_prefix}_{time.strftime("%Y%m%d-%H%M%S")}.prof'
+        self.profiler.dump_stats(output_path)
+        self.profiler = None
+        return output_path
+
+
+def memory_usage():
+    #peak resident memory (MB) of this process and of its joined child processes (the readers). None without the resource module (windows)
+    try:
+        import resource
+    except ImportError:
+        return {'max_rss_mb':None, 'children_max_rss_mb':None}
+    scale = 1/2**20 if sys.platform == 'darwin' else 1/2**10 #ru_maxrss is bytes on macos, kilobytes on linux
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+    try:
+        #linux keeps ru_maxrss across exec, so a script started from a big parent would report the parent's peak. VmHWM starts fresh
+        with open('/proc/self/status') as openfile:
+            max_rss_mb = next(int(line.split()[1]) for line in openfile if line.startswith('VmHWM:'))/2**10
+    except (OSError, StopIteration):
+        pass
+    return {'max_rss_mb':max_rss_mb, 'children_max_rss_mb':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale}
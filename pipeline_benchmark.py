@@ -0,0 +1,270 @@
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen') #must be set before Qt is imported
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from frame_schema import FrameSchema
+from shared_ring_buffer import SharedRingBuffer
+from serial_reading_handler import SerialRead
+from serial_sources import SyntheticSource
+from flight_log import FlightLogWriter, LegacyCsvWriter, open_flight_log
+from perf_counters import pipeline_counters
+from multi_device import DeviceConfig, MultiDeviceRead, merged_schema
+from user_serial_data_classes import GenericSerialData, imu_data_streams
+
+#end to end benchmark of the serial-to-pixel pipeline against synthetic packets
+#every case runs the real SerialRead process, shared memory ring, log writers and FlightDisplay (offscreen)
+STRIP_CHARTS = [f'plotobj_strip_chart_{i}' for i in range(1, 7)]
+
+
+def make_data_streams(n_streams, prefix=''):
+    #the flight display's own 8 streams, padded with extra strip chart streams
+    data_streams = imu_data_streams(prefix)
+    for i in range(n_streams - len(data_streams)):
+        data_streams.insert(6 + i, GenericSerialData(f'{prefix}Extra {i}', STRIP_CHARTS[i % len(STRIP_CHARTS)]))
+    return data_streams
+
+def percentiles(values, scale=1.0):
+    if not len(values):
+        return None
+    values = np.asarray(values)*scale
+    return {'p50':float(np.percentile(values, 50)), 'p95':float(np.percentile(values, 95)), 'p99':float(np.percentile(values, 99)), 'max':float(values.max())}
+
+def bench_decode(n_streams, duration):
+    #reader alone against an unpaced source: how many frames per second SerialRead can decode and hand over
+    data_streams = make_data_streams(n_streams)
+    data_ring = SharedRingBuffer(FrameSchema(data_streams).record_dtype)
+    serial_reader = SerialRead(None, None, None, data_streams, data_ring, source=SyntheticSource(data_streams, rate_hz=0, timeout=1))
+    latencies = []
+    n_frames = 0
+    data_ring.wait(5)
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        data_ring.wait(0.01)
+        records = data_ring.peek()
+        if len(records):
+            latencies.append(time.time() - records['timestamp'])
+            n_frames += len(records)
+            data_ring.release(len(records))
+    elapsed = time.perf_counter() - start
+    serial_reader.shutdown()
+    result = {
+        'decode_frames_per_s':n_frames/elapsed,
+        'ring_transfer_latency_ms':percentiles(np.concatenate(latencies) if latencies else [], 1e3),
+        'ring_dropped_frames':data_ring.dropped_frames()
+    }
+    data_ring.close()
+    return result
+
+def bench_merge(n_devices, rate_hz, duration):
+    #n synthetic devices, each in its own reader process, merged into one ring: merged throughput and arrival-to-merged-ring latency
+    devices = []
+    for i in range(n_devices):
+        data_streams = make_data_streams(8, f'imu{i} ')
+        devices.append(DeviceConfig(f'imu{i}', data_streams, SyntheticSource(data_streams, rate_hz=rate_hz, timeout=1)))
+    data_ring = SharedRingBuffer(merged_schema(devices).record_dtype)
+    multi_reader = MultiDeviceRead(devices, data_ring)
+    latencies = []
+    n_frames = 0
+    data_ring.wait(5)
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        if data_ring.wait(0.1):
+            records = data_ring.read()
+            latencies.append(time.time() - records['timestamp'])
+            n_frames += len(records)
+    elapsed = time.perf_counter() - start
+    multi_reader.shutdown()
+    counters = multi_reader.perf_counters.snapshot()
+    result = {
+        'merged_frames_per_s':n_frames/elapsed,
+        'merge_latency_ms':percentiles(np.concatenate(latencies) if latencies else [], 1e3),
+        'merge_busy':counters['merge_busy_s']/elapsed,
+        'merge_late_frames':counters['merge_late_frames'],
+        'ring_dropped_frames':data_ring.dropped_frames()
+    }
+    data_ring.close()
+    return result
+
+def bench_logging(n_streams, n_records, batch_size, directory):
+    #log writer throughput from the data handler's point of view (enqueue) and until the data is on disk (close)
+    data_streams = make_data_streams(n_streams)
+    frame_schema = FrameSchema(data_streams)
+    batch = np.zeros(batch_size, dtype=frame_schema.record_dtype)
+    result = {}
+    for name, make_writer in (
+        ('binary', lambda: FlightLogWriter(os.path.join(directory, 'bench.imulog'), frame_schema)),
+        ('legacy_csv', lambda: LegacyCsvWriter(os.path.join(directory, 'bench.csv'), data_streams))
+    ):
+        log_writer = make_writer()
+        start = time.perf_counter()
+        for _ in range(n_records//batch_size):
+            log_writer.write(batch)
+        enqueued = time.perf_counter()
+        log_writer.close()
+        finished = time.perf_counter()
+        result[name] = {'enqueue_records_per_s':n_records/(enqueued - start), 'records_per_s':n_records/(finished - start)}
+    return result
+
+def bench_display(app, n_streams, rate_hz, duration, directory):
+    #the whole pipeline with a paced source, measured from inside FlightDisplay
+    from PyQt5 import QtCore, QtWidgets
+    from flight_display_child import FlightDisplay
+    data_streams = make_data_streams(n_streams)
+    data_ring = SharedRingBuffer(FrameSchema(data_streams).record_dtype)
+    log_path = os.path.join(directory, f'display_{n_streams}_{rate_hz}.imulog')
+    perf_counters = pipeline_counters(data_streams)
+    serial_reader = SerialRead(None, None, None, data_streams, data_ring, source=SyntheticSource(data_streams, rate_hz=rate_hz, timeout=1), perf_counters=perf_counters)
+
+    main_window = QtWidgets.QMainWindow()
+    ui = FlightDisplay()
+    ui.setupUi(main_window)
+    ui.user_setup(data_streams, serial_reader, data_ring, log_path=log_path, perf_counters=perf_counters)
+    main_window.show()
+
+    #wrap the per-stream update_plot_batch calls and the refresh tick with timers
+    stream_times = {data_stream.name:[] for data_stream in data_streams}
+    for data_stream in data_streams:
+        def timed_update(samples, update=data_stream.update_plot_batch, times=stream_times[data_stream.name]):
+            start = time.perf_counter()
+            update(samples)
+            times.append(time.perf_counter() - start)
+        data_stream.update_plot_batch = timed_update
+    frame_times = []
+    screen_latencies = []
+    displayed_samples = [0]
+    update_plot_data = ui.update_plot_data
+    def timed_update_plot_data():
+        with ui.pending_lock:
+            pending_records = list(ui.pending_records)
+        start = time.perf_counter()
+        update_plot_data()
+        if ui.running and pending_records:
+            frame_times.append(time.perf_counter() - start)
+            now = time.time()
+            for records in pending_records:
+                screen_latencies.append(now - records['timestamp'])
+                displayed_samples[0] += len(records)
+    ui.timer.timeout.disconnect()
+    ui.timer.timeout.connect(timed_update_plot_data)
+
+    QtCore.QTimer.singleShot(int(duration*1000), app.quit)
+    app.exec_()
+    status_text = ui.statusbar.currentMessage()
+    ui.stop_collection() #shuts the reader down and joins the data handler
+    main_window.close()
+
+    header, records = open_flight_log(log_path)
+    result = {
+        'render_fps':len(frame_times)/duration,
+        'frame_time_ms':percentiles(frame_times, 1e3),
+        'update_plot_ms':{name:percentiles(times, 1e3) for name, times in stream_times.items()},
+        'logged_samples':len(records),
+        'displayed_samples':displayed_samples[0],
+        'undisplayed_samples':max(len(records) - displayed_samples[0], 0),
+        'dropped_frames':data_ring.dropped_frames(),
+        'sensor_to_screen_latency_ms':percentiles(np.concatenate(screen_latencies) if screen_latencies else [], 1e3),
+        'counters':perf_counters.snapshot(),
+        'status':status_text
+    }
+    del records
+    data_ring.close()
+    return result
+
+def bench_idle(app, n_streams, rate_hz, duration, directory):
+    #cpu use of both processes while the display is up but the reader is paused, then while it is running
+    from PyQt5 import QtCore, QtWidgets
+    from flight_display_child import FlightDisplay
+    data_streams = make_data_streams(n_streams)
+    data_ring = SharedRingBuffer(FrameSchema(data_streams).record_dtype)
+    perf_counters = pipeline_counters(data_streams)
+    serial_reader = SerialRead(None, None, None, data_streams, data_ring, source=SyntheticSource(data_streams, rate_hz=rate_hz, timeout=1), perf_counters=perf_counters, poll_interval=0.05)
+
+    main_window = QtWidgets.QMainWindow()
+    ui = FlightDisplay()
+    ui.setupUi(main_window)
+    ui.user_setup(data_streams, serial_reader, data_ring, log_path=os.path.join(directory, 'idle.imulog'), perf_counters=perf_counters)
+    main_window.show()
+
+    def cpu_fractions():
+        #reader_cpu_s is refreshed by the reader on every loop, gui_cpu_s by the perf monitor
+        ui.perf_monitor.sample()
+        app.processEvents()
+        return perf_counters.get('reader_cpu_s'), perf_counters.get('gui_cpu_s'), time.perf_counter()
+
+    def measure():
+        start = cpu_fractions()
+        QtCore.QTimer.singleShot(int(duration*1000), app.quit)
+        app.exec_()
+        time.sleep(2*serial_reader.poll_interval) #let the reader publish its cpu time once more
+        end = cpu_fractions()
+        elapsed = end[2] - start[2]
+        return {'reader_cpu':(end[0] - start[0])/elapsed, 'gui_cpu':(end[1] - start[1])/elapsed}
+
+    result = {'running':measure()}
+    serial_reader.pause()
+    time.sleep(0.1)
+    result['paused'] = measure()
+    ui.stop_collection()
+    main_window.close()
+    data_ring.close()
+    return result
+
+def bench_startup(rate_hz, duration, directory):
+    #startup time and peak memory of the capture-only and GUI entry points, each in a fresh interpreter
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for mode, script in (('headless', 'headless_capture.py'), ('gui', 'flight_display_child.py')):
+        command = [sys.executable, os.path.join(here, script), '--synthetic', str(rate_hz), '--duration', str(duration), '--report-startup']
+        if mode == 'headless':
+            command += ['--log', os.path.join(directory, 'startup.imulog')]
+        start = time.perf_counter()
+        completed = subprocess.run(command, capture_output=True, text=True, cwd=directory, env={**os.environ, 'QT_QPA_PLATFORM':'offscreen'})
+        report_lines = [line for line in completed.stdout.splitlines() if line.startswith('{')]
+        result[mode] = {'wall_s':time.perf_counter() - start, **(json.loads(report_lines[-1]) if report_lines else {'error':completed.stderr[-2000:]})}
+    return result
+
+def version_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit':commit, 'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform(), 'time':time.time()}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the serial-to-pixel pipeline')
+    parser.add_argument('--rates', type=float, nargs='+', default=[100, 500, 1000, 5000], help='packet rates (Hz) to sweep')
+    parser.add_argument('--streams', type=int, nargs='+', default=[8, 16, 32], help='stream counts to sweep')
+    parser.add_argument('--devices', type=int, nargs='+', default=[2, 4], help='device counts for the multi-device merge cases')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per case')
+    parser.add_argument('--log-records', type=int, default=200000)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    from PyQt5 import QtWidgets
+    app = QtWidgets.QApplication(sys.argv)
+    results = {'version':version_info(), 'decode':[], 'logging':[], 'display':[], 'merge':[], 'idle':None, 'startup':None}
+    with tempfile.TemporaryDirectory() as directory:
+        for n_streams in args.streams:
+            print(f'decode/logging: {n_streams} streams')
+            results['decode'].append({'n_streams':n_streams, **bench_decode(n_streams, args.duration)})
+            results['logging'].append({'n_streams':n_streams, **bench_logging(n_streams, args.log_records, 64, directory)})
+            for rate_hz in args.rates:
+                print(f'display: {n_streams} streams at {rate_hz} Hz')
+                results['display'].append({'n_streams':n_streams, 'rate_hz':rate_hz, **bench_display(app, n_streams, rate_hz, args.duration, directory)})
+        for n_devices in args.devices:
+            print(f'merge: {n_devices} devices at {args.rates[-1]} Hz')
+            results['merge'].append({'n_devices':n_devices, 'rate_hz':args.rates[-1], **bench_merge(n_devices, args.rates[-1], args.duration)})
+        print('startup: headless and gui')
+        results['startup'] = bench_startup(args.rates[0], 2.0, directory)
+        print('idle cpu')
+        results['idle'] = {'n_streams':args.streams[0], 'rate_hz':args.rates[0], **bench_idle(app, args.streams[0], args.rates[0], args.duration, directory)}
+    with open(args.output, 'w') as openfile:
+        json.dump(results, openfile, indent=2)
+    print(f'results written to {args.output}')
@@ -0,0 +1,128 @@
+import numpy as np
+import pyqtgraph as pg
+from pyqtgraph.opengl import GLLinePlotItem, GLAxisItem
+
+#everything that touches pyqtgraph/OpenGL. the data classes import this module only when a plot is attached,
+#so capture-only runs (headless_capture.py) and the reader processes never load Qt or OpenGL
+
+
+MAX_MARKERS = 100 #marker lines drawn per strip chart, the newest ones in view
+
+
+class StripChartRenderer:
+    #draws a MinMaxHistory on a PlotWidget with mouse pan/zoom
+    #plot x is the sample number minus x_origin. while following live the origin moves with the newest sample,
+    #so the view range (and the axis) stays put and only the curve data changes
+    def __init__(self, plot_widget, history, window_size, color=(255, 0, 0)):
+        self.plot_widget = plot_widget
+        self.history = history
+        self.window_size = window_size
+        self.follow_live = True #cleared when the view is panned/zoomed away from the newest sample
+        self.live_width = window_size
+        self.x_origin = 0
+        self.marker_samples = np.empty(0) #sorted sample numbers of event markers
+        self.marker_lines = [] #reused InfiniteLines, only the markers in view are shown
+
+        plot_widget.setYRange(-10,20, padding=0.05)
+        self.plot_handler = plot_widget.plot([], [], pen = pg.mkPen(color=color))
+        plot_widget.getViewBox().sigRangeChangedManually.connect(self.view_changed) #mouse pan/zoom only, not our own scrolling
+        plot_widget.setXRange(-self.live_width, 0, padding=0)
+
+    def update(self, n_new_samples):
+        if self.follow_live:
+            self.x_origin = len(self.history)
+            self.redraw()
+        elif self.plot_widget.getViewBox().viewRange()[0][1] + self.x_origin >= len(self.history) - n_new_samples: #new samples are in view
+            self.redraw()
+
+    def view_changed(self, changed_axes):
+        #back at the newest sample means following live again, at the new zoom width
+        x_start, x_end = self.plot_widget.getViewBox().viewRange()[0]
+        self.follow_live = x_end + self.x_origin >= len(self.history) - 1
+        if self.follow_live:
+            self.live_width = x_end - x_start
+            self.x_origin = len(self.history)
+            self.plot_widget.setXRange(-self.live_width, 0, padding=0)
+        self.redraw()
+
+    def scroll_to(self, sample):
+        #right edge of the view at sample, same zoom width. stops following live, e.g. when scrubbing a stored session
+        x_start, x_end = self.plot_widget.getViewBox().viewRange()[0]
+        self.follow_live = False
+        self.plot_widget.setXRange(sample - self.x_origin - (x_end - x_start), sample - self.x_origin, padding=0)
+        self.redraw()
+
+    def redraw(self):
+        view_box = self.plot_widget.getViewBox()
+        x_start, x_end = view_box.viewRange()[0]
+        n_pixels = int(view_box.width()) or self.window_size
+        x_data, y_data = self.history.query(x_start + self.x_origin, x_end + self.x_origin, n_pixels)
+        self.plot_handler.setData(x_data - self.x_origin, y_data)
+        if len(self.marker_samples):
+            self.draw_markers(x_start, x_end)
+
+    def set_markers(self, sample_indices):
+        self.marker_samples = np.sort(sample_indices)
+        self.redraw()
+
+    def draw_markers(self, x_start, x_end):
+        first, last = np.searchsorted(self.marker_samples, [x_start + self.x_origin, x_end + self.x_origin])
+        visible = self.marker_samples[first:last][-MAX_MARKERS:]
+        while len(self.marker_lines) < len(visible):
+            marker_line = pg.InfiniteLine(angle=90, pen=pg.mkPen(color=(255, 255, 255), style=pg.QtCore.Qt.DashLine))
+            self.plot_widget.addItem(marker_line)
+            self.marker_lines.append(marker_line)
+        for marker_line, sample in zip(self.marker_lines, visible):
+            marker_line.setValue(sample - self.x_origin)
+            marker_line.show()
+        for marker_line in self.marker_lines[len(visible):]:
+            marker_line.hide()
+
+
+class LineRenderer3d:
+    #one GL line item plus axes in a GLViewWidget. mode 'line_strip' joins all points, 'lines' draws point pairs
+    def __init__(self, plot_figure, pos, mode='line_strip'):
+        self.line_handler = GLLinePlotItem(pos=np.asarray(pos), mode=mode, width=2, antialias=False)
+        plot_figure.addItem(self.line_handler)
+        plot_figure.addItem(GLAxisItem())
+        plot_figure.setCameraParams(azimuth=22.5,distance=3)
+
+    def set_positions(self, pos):
+        self.line_handler.setData(pos=pos)
+
+
+SPECTRUM_COLORS = [(255, 0, 0), (0, 255, 0), (0, 128, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
+
+class SpectrumRenderer:
+    #newest power spectrum of every channel as one curve each, dB over Hz
+    def __init__(self, plot_widget, frequencies, channel_names, db_range):
+        self.frequencies = frequencies
+        plot_widget.setLabel('bottom', 'frequency', units='Hz')
+        plot_widget.setLabel('left', 'PSD', units='dB')
+        plot_widget.setXRange(frequencies[0], frequencies[-1], padding=0)
+        plot_widget.setYRange(*db_range, padding=0)
+        plot_widget.addLegend(offset=(-10, 10))
+        self.curves = [plot_widget.plot([], [], pen=pg.mkPen(color=SPECTRUM_COLORS[i % len(SPECTRUM_COLORS)]), name=channel_name)
+                       for i, channel_name in enumerate(channel_names)]
+
+    def set_spectra(self, spectra_db):
+        for curve, spectrum_db in zip(self.curves, spectra_db):
+            curve.setData(self.frequencies, spectrum_db)
+
+
+class WaterfallRenderer:
+    #spectrogram of one channel, frequency across and seconds before now downwards, newest row on top
+    def __init__(self, plot_widget, frequencies, n_rows, row_period_s, channel_name, db_range):
+        self.db_range = db_range
+        self.image_item = pg.ImageItem(axisOrder='row-major')
+        self.image_item.setLookupTable(pg.colormap.get('viridis').getLookupTable())
+        bin_width = frequencies[1] - frequencies[0]
+        self.image_item.setRect(pg.QtCore.QRectF(frequencies[0] - bin_width/2, -n_rows*row_period_s, len(frequencies)*bin_width, n_rows*row_period_s))
+        plot_widget.addItem(self.image_item)
+        plot_widget.setTitle(channel_name)
+        plot_widget.setLabel('bottom', 'frequency', units='Hz')
+        plot_widget.setLabel('left', 'time', units='s')
+
+    def set_spectra(self, waterfall_db):
+        #rows come oldest first, the image is drawn bottom up so the newest row ends up at time 0
+        self.image_item.setImage(waterfall_db, levels=self.db_range, autoLevels=False)
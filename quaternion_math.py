@@ -0,0 +1,56 @@
+import numpy as np
+
+#vectorized quaternion helpers. quaternions are (w, x, y, z) like the BNO055 sends them
+#every function takes a single quaternion of shape (4,) or a batch of shape (N,4)
+
+
+def normalize(quaternions):
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+    norms = np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    #an all zero quaternion (sensor not initialized yet) becomes the identity instead of nan
+    identity = np.zeros_like(quaternions)
+    identity[..., 0] = 1.0
+    return np.where(norms > 0, quaternions / np.where(norms > 0, norms, 1.0), identity)
+
+def conjugate(quaternions):
+    return np.asarray(quaternions, dtype=np.float64) * np.array([1.0, -1.0, -1.0, -1.0])
+
+def multiply(quaternions_1, quaternions_2):
+    #hamilton product, broadcasts so a single quaternion can be applied to a batch
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(quaternions_1, dtype=np.float64), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(quaternions_2, dtype=np.float64), -1, 0)
+    w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
+    x = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
+    y = w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2
+    z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
+    return np.stack((w, x, y, z), axis=-1)
+
+def from_axisangle(theta, axes):
+    axes = np.asarray(axes, dtype=np.float64)
+    axes = axes / np.linalg.norm(axes, axis=-1, keepdims=True)
+    half_theta = np.asarray(theta, dtype=np.float64)[..., np.newaxis] / 2.
+    return np.concatenate((np.cos(half_theta), axes * np.sin(half_theta)), axis=-1)
+
+def to_rotation_matrix(quaternions):
+    #returns (3,3) or (N,3,3) rotation matrices of the normalized quaternions
+    w, x, y, z = np.moveaxis(normalize(quaternions), -1, 0)
+    return np.stack((
+        np.stack((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)), axis=-1),
+        np.stack((2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)), axis=-1),
+        np.stack((2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)), axis=-1)
+    ), axis=-2)
+
+def rotate_vectors(quaternions, vectors):
+    #rotates an (M,3) vertex array (or a single vector) in one matmul
+    #a batch of N quaternions gives an (N,M,3) result
+    rotation_matrices = to_rotation_matrix(quaternions)
+    return np.asarray(vectors, dtype=np.float64) @ np.swapaxes(rotation_matrices, -1, -2)
+
+def from_euler(euler_angles, degrees=True):
+    #BNO055 euler output (heading, roll, pitch): heading turns clockwise about z (compass), then pitch about x, then roll about y
+    euler_angles = np.asarray(euler_angles, dtype=np.float64)
+    if degrees:
+        euler_angles = np.radians(euler_angles)
+    heading, roll, pitch = np.moveaxis(euler_angles, -1, 0)
+    axes = np.eye(3)
+    return multiply(multiply(from_axisangle(-heading, axes[2]), from_axisangle(pitch, axes[0])), from_axisangle(roll, axes[1]))
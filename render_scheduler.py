@@ -0,0 +1,114 @@
+import time
+import numpy as np
+
+#render classes in the order they are slowed down when frames go over budget. a stream's class is its render_class attribute
+DEGRADE_ORDER = ['spectrum', 'view3d', 'strip']
+MAX_DIVISOR = 8 #a degraded class is drawn every 2nd, 4th or 8th frame
+
+
+class RenderScheduler:
+    #decides what gets drawn on each display refresh tick. only streams with new samples are redrawn, and when a frame
+    #takes longer than the budget the least important views are drawn less often until frames fit again
+    def __init__(self, data_streams, perf_counters, target_fps=60.0, recover_after_s=1.0, views=()):
+        self.data_streams = data_streams
+        self.views = list(views) #e.g. spectrum_view.SpectrumView, fed outside the GUI thread. they say themselves when they have new data
+        self.perf_counters = perf_counters
+        self.render_counter_names = [f'render_s:{data_stream.name}' for data_stream in data_streams]
+        self.pending_samples = {data_stream.name:[] for data_stream in data_streams} #samples not drawn yet, per stream
+        self.divisors = dict.fromkeys(DEGRADE_ORDER, 1)
+        self.recover_after_s = recover_after_s
+        self.set_target_fps(target_fps)
+
+        self.frame_index = 0
+        self.last_tick = None
+        self.calm_since = None
+
+    def set_target_fps(self, target_fps):
+        self.target_fps = target_fps
+        self.frame_budget = 1/target_fps
+
+    def add(self, batch):
+        #batch of records from the data handler, every stream in it becomes dirty
+        for data_stream in self.data_streams:
+            self.pending_samples[data_stream.name].append(batch[data_stream.name])
+
+    def dirty(self):
+        return any(self.pending_samples.values()) or any(view.has_new_data() for view in self.views)
+
+    def render_frame(self):
+        #call once per refresh tick. returns whether anything was drawn
+        now = time.perf_counter()
+        self.count_missed_ticks(now)
+        if not self.dirty():
+            return False
+
+        frame_start = time.perf_counter()
+        class_s = {} #draw time per render class in this frame
+        for data_stream, counter_name in zip(self.data_streams, self.render_counter_names):
+            pending_samples = self.pending_samples[data_stream.name]
+            render_class = getattr(data_stream, 'render_class', 'strip')
+            if not pending_samples or self.frame_index % self.divisors.get(render_class, 1):
+                continue
+            samples = pending_samples[0] if len(pending_samples) == 1 else np.concatenate(pending_samples)
+            pending_samples.clear()
+            stream_start = time.perf_counter()
+            data_stream.update_plot_batch(samples)
+            stream_s = time.perf_counter() - stream_start
+            self.perf_counters.add(counter_name, stream_s)
+            class_s[render_class] = class_s.get(render_class, 0.0) + stream_s
+        for view in self.views:
+            if not view.has_new_data() or self.frame_index % self.divisors.get(view.render_class, 1):
+                continue
+            view_start = time.perf_counter()
+            view.update_plot()
+            view_s = time.perf_counter() - view_start
+            self.perf_counters.add('render_views_s', view_s)
+            class_s[view.render_class] = class_s.get(view.render_class, 0.0) + view_s
+        self.frame_index += 1
+        if not class_s:
+            return False
+
+        frame_s = time.perf_counter() - frame_start
+        self.perf_counters.add('render_frames')
+        self.perf_counters.add('render_s', frame_s)
+        self.adapt(frame_s, class_s, now)
+        return True
+
+    def count_missed_ticks(self, now):
+        #a tick that comes more than half a frame late is late, every whole frame period in the gap is a skipped frame
+        if self.last_tick is not None:
+            gap = now - self.last_tick
+            if gap > 1.5*self.frame_budget:
+                self.perf_counters.add('render_late_frames')
+                self.perf_counters.add('render_skipped_frames', int(gap/self.frame_budget + 0.5) - 1)
+        self.last_tick = now
+
+    def adapt(self, frame_s, class_s, now):
+        if frame_s > self.frame_budget:
+            self.perf_counters.add('render_over_budget_frames')
+            self.calm_since = None
+            #slow down the first class drawn in this frame that can still go slower. a class that is already at the
+            #slowest rate only passes the blame on if the frame would still be over budget without it
+            remaining_s = frame_s
+            for render_class in DEGRADE_ORDER:
+                if render_class not in class_s:
+                    continue
+                if self.divisors[render_class] < MAX_DIVISOR:
+                    self.divisors[render_class] *= 2
+                    break
+                remaining_s -= class_s[render_class]
+                if remaining_s <= self.frame_budget:
+                    break
+        elif frame_s < 0.5*self.frame_budget:
+            #restore in reverse order after a calm period, so strip charts get their rate back first
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since > self.recover_after_s:
+                self.calm_since = now
+                for render_class in reversed(DEGRADE_ORDER):
+                    if self.divisors[render_class] > 1:
+                        self.divisors[render_class] //= 2
+                        break
+        else:
+            self.calm_since = None
+        self.perf_counters.set('render_degrade_level', sum(int(np.log2(divisor)) for divisor in self.divisors.values()))
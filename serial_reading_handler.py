@@ -1,69 +1,153 @@
 import threading
-import serial
 import multiprocessing as mp
 import time
+from frame_schema import FrameSchema, FrameParser
+from derived_channels import compute_derived
+from serial_sources import SerialPortSource
+from perf_counters import pipeline_counters
+
+#reader states, changed through commands on the control queue
+RUNNING = 'running'
+PAUSED = 'paused' #port stays open, nothing is read. resume drops what queued up meanwhile
+STOPPED = 'stopped' #port closed until the next start
+SHUTDOWN = 'shutdown'
 
 
 class SerialRead:
-    def __init__(self, port, baudrate, timeout, data_streams, data_queue, process_queue):
-        self.running = True
-        self.process_queue = process_queue
+    def __init__(self, port, baudrate, timeout, data_streams, data_ring, control_queue=None, max_frames_per_read=64, source=None, perf_counters=None, protocol=1, poll_interval=0.05, derived_channels=()):
+        self.control_queue = control_queue if control_queue is not None else mp.SimpleQueue()
+        #where the bytes come from. defaults to the real port, see serial_sources for replay/synthetic/pty sources
+        self.source = source if source is not None else SerialPortSource(port, baudrate, timeout)
+        #longest a blocking read waits before commands are looked at again
+        self.poll_interval = poll_interval
 
         #serial data parsing
         self.data_streams = data_streams
+        self.max_frames_per_read = max_frames_per_read
+        self.protocol = protocol #1 is the original sketch framing, 2 adds length, sequence counter and CRC
+        self.derived_channels = list(derived_channels) #computed here per batch, their filter state lives in this process
+        self.perf_counters = perf_counters if perf_counters is not None else pipeline_counters(data_streams)
 
-        #serial_reading thread
-        serial_reading_process = mp.Process(target=self.serial_reading, args=(port, baudrate, timeout, data_queue))
-        serial_reading_process.start()
-
-    def serial_reading(self, port, baudrate, timeout, queue):
-        #thread to check if main process has ended
-        run_checker_thread = threading.Thread(target=self.run_checker, args=(self.process_queue,))
-        run_checker_thread.start()
-
-        serial_connection = serial.Serial(port=port,baudrate=baudrate, timeout=timeout)
-        self.synchronize_connection(serial_connection)
-
-        while self.running:
-            if serial_connection.in_waiting:
-                data_list = []
-                for data_stream in self.data_streams:
-                    data_list.append(data_stream.get_data(serial_connection))
-                queue.put(data_list)
-                if not self.synchronized(serial_connection): #check if synchronized. also clears sync bits
-                    print('desync ... resynchronizing')
-                    self.synchronize_connection(serial_connection)
-        print('Serial reading stopped')
+        #serial_reading process
+        self.process = mp.Process(target=self.serial_reading, args=(data_ring,))
+        self.process.start()
+
+    def __getstate__(self):
+        #the process handle stays with the parent
+        state = self.__dict__.copy()
+        state['process'] = None
+        return state
+
+    #control side, called from the GUI process
+    def send(self, command, **options):
+        self.control_queue.put((command, options))
+
+    def start(self):
+        self.send('start')
+
+    def stop(self):
+        self.send('stop')
+
+    def pause(self):
+        self.send('pause')
 
-    def run_checker(self, process_queue):
-        while True:
-            if not process_queue.empty():
-                self.running = process_queue.get()
-                break
-
-    def synchronize_connection(self, serial_connection):
-        time.sleep(1)
-        while serial_connection.in_waiting > 0:
-            serial_connection.read()
-        sync_false=True
-        while sync_false:
-            sync_byte=b'\x00'
-            for i in range(4):
-                if serial_connection.read() != sync_byte:
-                    break
-                if sync_byte == b'\x00': 
-                    sync_byte=b'\xff'
+    def resume(self):
+        self.send('resume')
+
+    def configure(self, **options):
+        #e.g. configure(port='COM4', baudrate=921600). the source is updated and reopened
+        self.send('configure', **options)
+
+    def shutdown(self, timeout=5):
+        if self.process is None or not self.process.is_alive():
+            return
+        self.send('shutdown')
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    #reader process
+    def serial_reading(self, data_ring):
+        self.state = RUNNING
+        self.reopen = False
+        self.reset_input = False
+        self.state_changed = threading.Event()
+        command_thread = threading.Thread(target=self.command_listener, daemon=True)
+        command_thread.start()
+
+        perf_counters = self.perf_counters
+        frame_schema = FrameSchema(self.data_streams, derived_channels=self.derived_channels)
+        record_dtype = frame_schema.record_dtype
+        serial_connection = None
+        while self.state != SHUTDOWN:
+            perf_counters.set('reader_cpu_s', time.process_time())
+            if serial_connection is not None and (self.state == STOPPED or self.reopen):
+                serial_connection.close()
+                serial_connection = None
+                self.reopen = False
+            if self.state != RUNNING:
+                self.state_changed.wait(self.poll_interval) #the timeout only keeps reader_cpu_s fresh while idle
+                self.state_changed.clear()
+                continue
+            if serial_connection is None:
+                serial_connection = self.source.open()
+                serial_connection.timeout = self.poll_interval
+                serial_connection.reset_input_buffer() #drop whatever queued up before the reader started
+                #sources that don't carry sketch packets (e.g. frame_publisher.SubscriberSource) bring their own parser
+                if hasattr(self.source, 'make_parser'):
+                    frame_parser = self.source.make_parser(record_dtype, self.protocol, self.max_frames_per_read)
                 else:
-                    sync_byte=b'\x00'
-            if i==3:
-                sync_false=False
-                #print("Sync Detected")
-    
-    def synchronized(self, serial_connection):
-        if serial_connection.read(size=4)==b'\x00\xff\x00\xff':
-            return True
-        else: 
-            return False
+                    frame_parser = FrameParser(record_dtype, self.protocol, max_frames=self.max_frames_per_read, field_names=frame_schema.field_names)
+            if self.reset_input:
+                serial_connection.reset_input_buffer()
+                self.reset_input = False
+
+            #blocks until at least one byte arrives or poll_interval passes, then takes everything waiting
+            n_bytes = frame_parser.read_from(serial_connection, max(serial_connection.in_waiting, 1))
+            if n_bytes:
+                busy_start = time.perf_counter()
+                blocked_s = data_ring.blocked_s #waiting for ring space is not busy time
+                resyncs = frame_parser.resyncs
+                records = frame_parser.parse(time.time())
+                if self.derived_channels:
+                    derive_start = time.perf_counter()
+                    compute_derived(records, self.derived_channels)
+                    perf_counters.add('reader_derive_s', time.perf_counter() - derive_start)
+                data_ring.write(records, cancel=lambda: self.state != RUNNING) #a BLOCK ring is given up on by stop, pause and shutdown
+                perf_counters.add('reader_bytes', n_bytes)
+                perf_counters.add('reader_frames', len(records))
+                if frame_parser.resyncs != resyncs:
+                    perf_counters.add('reader_resyncs', frame_parser.resyncs - resyncs)
+                perf_counters.set('reader_crc_errors', frame_parser.crc_errors)
+                perf_counters.set('reader_dropped_frames', frame_parser.dropped_frames)
+                perf_counters.set('reader_blocked_s', data_ring.blocked_s)
+                perf_counters.add('reader_busy_s', time.perf_counter() - busy_start - data_ring.blocked_s + blocked_s)
+        if serial_connection is not None:
+            serial_connection.close()
+        print('Serial reading stopped')
+
+    def command_listener(self):
+        #blocks on the control queue, the reading loop only looks at the resulting state
+        while self.state != SHUTDOWN:
+            command, options = self.control_queue.get()
+            if command == 'start':
+                self.state = RUNNING
+            elif command == 'stop':
+                self.state = STOPPED
+            elif command == 'pause':
+                self.state = PAUSED
+            elif command == 'resume':
+                if self.state == PAUSED:
+                    self.reset_input = True
+                self.state = RUNNING
+            elif command == 'configure':
+                for name, value in options.items():
+                    setattr(self.source, name, value)
+                self.reopen = True
+            elif command == 'shutdown':
+                self.state = SHUTDOWN
+            self.state_changed.set()
 
 
 if __name__=='__main__':
@@ -74,7 +158,7 @@ if __name__=='__main__':
     #     # {'Name':'Stream4','Byte Length':2,'Format':'Unsigned Short','Display':'sub_plot_2'},
     #     # {'Name':'Stream5','Byte Length':2,'Format':'Unsigned Short','Display':'sub_plot_3'}
     # ]
-    # data_queue = mp.SimpleQueue()
-    # running_queue = mp.SimpleQueue()
-    # SerialRead('COM4',115200, 5, my_data_streams, data_queue, running_queue)
+    # data_ring = SharedRingBuffer(FrameSchema(my_data_streams).record_dtype)
+    # serial_reader = SerialRead('COM4',115200, 5, my_data_streams, data_ring)
+    # serial_reader.shutdown()
     pass
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+import numpy as np
+import serial
+from frame_schema import FrameSchema, packet_dtype, encode_packets
+from flight_log import open_flight_log
+
+#sources are small picklable descriptions handed to SerialRead. open() runs inside the reader process
+#and returns something that behaves like serial.Serial for the calls the reader makes
+
+
+class SerialPortSource:
+    def __init__(self, port, baudrate, timeout):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+
+    def open(self):
+        return serial.Serial(port=self.port, baudrate=self.baudrate, timeout=self.timeout)
+
+
+class ReplaySource:
+    #feeds a recorded flight log back in the sketch's framing (00 FF 00 FF + packet, or protocol 2)
+    #speed 1.0 is real time, 4.0 is 4x, None replays as fast as the reader takes it
+    def __init__(self, log_path, speed=1.0, timeout=5, loop=False, protocol=1):
+        self.log_path = log_path
+        self.speed = speed
+        self.timeout = timeout
+        self.loop = loop
+        self.protocol = protocol
+
+    def open(self):
+        header, records = open_flight_log(self.log_path)
+        #only what the sketch sent goes back on the wire, derived channels and the merged device index are recomputed by the reader
+        records = records[['timestamp'] + [stream['name'] for stream in header['streams'] if not stream.get('derived', False)]]
+        return VirtualSerialConnection(ReplayFrames(records, self.speed, self.loop, self.protocol), self.timeout)
+
+
+class SyntheticSource:
+    #generated packets for the given data_streams at any rate, including ones the BNO055 can't produce
+    def __init__(self, data_streams, rate_hz=100.0, noise=0.01, timeout=5, seed=None, protocol=1):
+        self.data_streams = data_streams
+        self.rate_hz = rate_hz
+        self.noise = noise
+        self.timeout = timeout
+        self.seed = seed
+        self.protocol = protocol
+
+    def open(self):
+        return VirtualSerialConnection(SyntheticFrames(FrameSchema(self.data_streams), self.rate_hz, self.noise, self.seed, self.protocol), self.timeout)
+
+
+class PtySource:
+    #pushes another source's bytes through a linux pseudo terminal so the reader opens it with the real pyserial path
+    def __init__(self, source, baudrate=115200):
+        self.source = source
+        self.baudrate = baudrate
+
+    def open(self):
+        import tty
+        master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        #the inner source is only opened once the reader has reset the port, so nothing is flushed and the replay clock
+        #starts with the first byte the reader can see
+        def start_pump():
+            inner_connection = self.source.open()
+            threading.Thread(target=self.pump, args=(inner_connection, master_fd), daemon=True).start()
+        return PtySerial(start_pump, port=os.ttyname(slave_fd), baudrate=self.baudrate, timeout=self.source.timeout)
+
+    def pump(self, inner_connection, master_fd):
+        while True:
+            data = inner_connection.read(max(inner_connection.in_waiting, 1))
+            if data:
+                os.write(master_fd, data)
+            elif inner_connection.exhausted():
+                break
+
+
+class PtySerial(serial.Serial):
+    #the reader's end of a PtySource. starts the pump on the first reset_input_buffer (SerialRead's flush right after open)
+    #or read, whichever comes first
+    def __init__(self, start_pump, **kwargs):
+        super().__init__(**kwargs)
+        self.start_pump = start_pump
+
+    def start_pumping(self):
+        if self.start_pump is not None:
+            start_pump, self.start_pump = self.start_pump, None
+            start_pump()
+
+    def reset_input_buffer(self):
+        super().reset_input_buffer()
+        self.start_pumping()
+
+    def read(self, size=1):
+        self.start_pumping()
+        return super().read(size)
+
+
+class VirtualSerialConnection:
+    #pyserial look-alike that releases encoded frames when they are due
+    def __init__(self, frames, timeout, max_pending_frames=4096):
+        self.frames = frames
+        self.timeout = timeout
+        self.max_pending_frames = max_pending_frames
+        self.pending = bytearray()
+        self.frames_emitted = 0
+        self.start_time = time.perf_counter()
+
+    def pull(self):
+        if len(self.pending) >= self.max_pending_frames*self.frames.frame_size:
+            return
+        due_frames = self.frames.due_frames(time.perf_counter() - self.start_time, self.frames_emitted, self.max_pending_frames)
+        if due_frames > self.frames_emitted:
+            self.pending += self.frames.encode(self.frames_emitted, due_frames - self.frames_emitted)
+            self.frames_emitted = due_frames
+
+    def exhausted(self):
+        return not self.pending and self.frames.n_frames is not None and self.frames_emitted >= self.frames.n_frames
+
+    @property
+    def in_waiting(self):
+        self.pull()
+        return len(self.pending)
+
+    def read(self, size=1):
+        #like pyserial, waits up to timeout for size bytes
+        deadline = time.perf_counter() + (self.timeout if self.timeout is not None else float('inf'))
+        self.pull()
+        while len(self.pending) < size and time.perf_counter() < deadline:
+            if self.exhausted(): #nothing more will arrive, time out like a quiet port would
+                time.sleep(max(deadline - time.perf_counter(), 0))
+                break
+            #sleep until the next frame is due instead of polling
+            next_due = self.start_time + self.frames.next_due(self.frames_emitted)
+            time.sleep(max(min(next_due, deadline) - time.perf_counter(), 0))
+            self.pull()
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        #drops what has arrived so far. unpaced frames only arrive when asked for, so nothing is skipped
+        if self.frames.paced:
+            self.pull()
+        self.pending.clear()
+
+    def close(self):
+        self.pending.clear()
+
+
+class EncodedFrames:
+    #shared encoding of records into the packets the sketch sends
+    def __init__(self, record_dtype, protocol):
+        self.protocol = protocol
+        self.frame_size = packet_dtype(record_dtype, protocol).itemsize
+
+    def pack(self, records, first_frame):
+        return encode_packets(records, self.protocol, first_sequence=first_frame)
+
+
+class ReplayFrames(EncodedFrames):
+    def __init__(self, records, speed, loop, protocol):
+        super().__init__(records.dtype, protocol)
+        self.records = records
+        self.speed = speed
+        self.loop = loop
+        self.n_frames = None if loop else len(records)
+        self.paced = bool(speed)
+        self.relative_times = np.asarray(records['timestamp'] - records['timestamp'][0]) if len(records) else np.zeros(0)
+        self.duration = self.relative_times[-1] + 1e-3 if len(records) else 0.0
+
+    def due_frames(self, elapsed, frames_emitted, max_frames):
+        if not self.speed:
+            due = frames_emitted + max_frames
+        else:
+            log_time = elapsed*self.speed
+            n_records = len(self.records)
+            if self.loop and n_records:
+                laps, log_time = divmod(log_time, self.duration)
+                due = int(laps)*n_records + int(np.searchsorted(self.relative_times, log_time, side='right'))
+            else:
+                due = int(np.searchsorted(self.relative_times, log_time, side='right'))
+        return due if self.n_frames is None else min(due, self.n_frames)
+
+    def next_due(self, frames_emitted):
+        if not self.speed or (self.n_frames is not None and frames_emitted >= self.n_frames):
+            return 0.0
+        laps, index = divmod(frames_emitted, len(self.records))
+        return (laps*self.duration + self.relative_times[index])/self.speed
+
+    def encode(self, start, n_frames):
+        indices = np.arange(start, start + n_frames) % len(self.records)
+        return self.pack(self.records[indices], start)
+
+
+class SyntheticFrames(EncodedFrames):
+    #sine waves plus gaussian noise. 4 value streams are generated as unit quaternions turning about z
+    def __init__(self, frame_schema, rate_hz, noise, seed, protocol):
+        super().__init__(frame_schema.record_dtype, protocol)
+        self.data_streams = frame_schema.data_streams
+        self.record_dtype = frame_schema.record_dtype
+        self.rate_hz = rate_hz
+        self.noise = noise
+        self.random = np.random.default_rng(seed)
+        self.n_frames = None
+        self.paced = bool(rate_hz)
+
+    def due_frames(self, elapsed, frames_emitted, max_frames):
+        if not self.rate_hz:
+            return frames_emitted + max_frames
+        return int(elapsed*self.rate_hz)
+
+    def next_due(self, frames_emitted):
+        return (frames_emitted + 1)/self.rate_hz if self.rate_hz else 0.0
+
+    def encode(self, start, n_frames):
+        sample_times = np.arange(start, start + n_frames) / (self.rate_hz or 1000.0)
+        records = np.empty(n_frames, dtype=self.record_dtype)
+        records['timestamp'] = sample_times
+        for stream_index, data_stream in enumerate(self.data_streams):
+            if data_stream.n_values == 4:
+                half_angle = 0.25*sample_times
+                values = np.column_stack((np.cos(half_angle), np.zeros(n_frames), np.zeros(n_frames), np.sin(half_angle)))
+            else:
+                phases = stream_index + np.arange(data_stream.n_values)
+                values = np.sin(2*np.pi*0.5*sample_times[:, np.newaxis] + phases)
+            values = values + self.random.normal(scale=self.noise, size=values.shape)
+            records[data_stream.name] = values.reshape(records[data_stream.name].shape)
+        return self.pack(records, start)
@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+import quaternion_math
+from frame_schema import dtype_from_json
+from flight_log import open_flight_log
+
+#post-flight store: a directory with one raw binary file per record field (columns) and a sparse time index, next to
+#session.json with the schema. SessionWriter appends to it during capture like the log writers, SessionStore memory maps
+#the columns, so a query only touches the pages of the channels and time range it asks for, however long the session is
+#the time index holds the running maximum of the timestamps at the end of every INDEX_STRIDE records. timestamps are
+#batch arrival times and can step back (clock adjustments, merged devices), the running maximum is always sorted
+#scalar channels also get a min/max pyramid like MinMaxHistory: level n files hold the min and max of every
+#PYRAMID_BRANCHING**n records, so scrubbing reads a few buckets per pixel instead of every record in view
+SESSION_FILE = 'session.json'
+TIME_INDEX_FILE = 'time_index.f8'
+INDEX_STRIDE = 256
+PYRAMID_BRANCHING = 4
+
+
+def column_file(field_name):
+    #'/dev/ttyUSB0 Accel X' -> '_dev_ttyUSB0_Accel_X.bin'
+    return re.sub(r'[^A-Za-z0-9.-]', '_', field_name) + '.bin'
+
+
+def pyramid_file(field_name, kind, level):
+    #'Accel X', 'min', 2 -> 'Accel_X.min2'
+    return re.sub(r'[^A-Za-z0-9.-]', '_', field_name) + f'.{kind}{level}'
+
+
+class SessionWriter:
+    #same write/close interface as the log writers. columns are appended on a dedicated thread, at most
+    #max_pending_batches wait for the disk before write blocks (see FlightLogWriter)
+    def __init__(self, path, frame_schema, max_pending_batches=256, buffer_records=4096):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.record_dtype = frame_schema.record_dtype
+        columns = {name:column_file(name) for name in self.record_dtype.names}
+        if len(set(columns.values())) < len(columns):
+            raise ValueError(f'Field names of {path} map to the same column file: {sorted(columns)}')
+        self.pyramid_channels = [name for name in self.record_dtype.names if name != 'timestamp'
+                                 and not self.record_dtype.fields[name][0].shape and self.record_dtype.fields[name][0].kind in 'iuf']
+        header = frame_schema.describe()
+        header.update({'created':time.time(), 'columns':columns, 'index_stride':INDEX_STRIDE,
+                       'pyramid':{'branching':PYRAMID_BRANCHING, 'channels':self.pyramid_channels}})
+        with open(os.path.join(path, SESSION_FILE), 'w') as openfile:
+            json.dump(header, openfile, indent=1)
+
+        self.column_files = {name:open(os.path.join(path, file_name), 'wb', buffering=buffer_records*self.record_dtype.fields[name][0].itemsize)
+                             for name, file_name in columns.items()}
+        self.index_file = open(os.path.join(path, TIME_INDEX_FILE), 'wb', buffering=0) #unbuffered, a reader never sees columns ahead of the index by more than a block
+        self.n_records = 0
+        self.latest_timestamp = -np.inf
+        self.buffer_records = buffer_records
+        self.pyramid_files = {name:[] for name in self.pyramid_channels} #(minimum, maximum) file per level from 1, opened when its first bucket completes
+        self.pyramid_tails = {name:[] for name in self.pyramid_channels} #per level, the lower level minimums and maximums of its incomplete bucket
+
+        self.record_queue = queue.Queue(max_pending_batches)
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.start()
+
+    def write(self, records):
+        #records must not be modified by the caller afterwards
+        self.record_queue.put(records)
+
+    def writer_loop(self):
+        while True:
+            records = self.record_queue.get()
+            if records is None:
+                break
+            self.append(records)
+        for openfile in self.column_files.values():
+            openfile.close()
+        for level_files in self.pyramid_files.values():
+            for minimum_file, maximum_file in level_files:
+                minimum_file.close()
+                maximum_file.close()
+        self.index_file.close()
+
+    def append(self, records):
+        if not len(records):
+            return
+        for name, openfile in self.column_files.items():
+            openfile.write(np.ascontiguousarray(records[name]).tobytes())
+        running_maximum = np.maximum.accumulate(np.concatenate(([self.latest_timestamp], records['timestamp'])))[1:]
+        self.latest_timestamp = running_maximum[-1]
+        #an entry for every record that completes a block of INDEX_STRIDE
+        first_block_end = -(self.n_records + 1) % INDEX_STRIDE
+        self.index_file.write(running_maximum[first_block_end::INDEX_STRIDE].astype('<f8').tobytes())
+        self.n_records += len(records)
+        for name in self.pyramid_channels:
+            self.append_pyramid(name, records[name])
+
+    def append_pyramid(self, name, values):
+        #incremental like MinMaxHistory.append: every level only reduces the buckets completed by this batch
+        minimums = maximums = values
+        level = 1
+        while len(minimums):
+            if len(self.pyramid_tails[name]) < level:
+                self.pyramid_tails[name].append((values[:0], values[:0]))
+            tail_minimums, tail_maximums = self.pyramid_tails[name][level-1]
+            lower_minimums, lower_maximums = np.concatenate((tail_minimums, minimums)), np.concatenate((tail_maximums, maximums))
+            n_full = len(lower_minimums)//PYRAMID_BRANCHING
+            complete = n_full*PYRAMID_BRANCHING
+            self.pyramid_tails[name][level-1] = (lower_minimums[complete:], lower_maximums[complete:])
+            minimums = lower_minimums[:complete].reshape(n_full, PYRAMID_BRANCHING).min(axis=1)
+            maximums = lower_maximums[:complete].reshape(n_full, PYRAMID_BRANCHING).max(axis=1)
+            if n_full:
+                if len(self.pyramid_files[name]) < level:
+                    #buffers hold about buffer_records records of every level, so no level lags the columns by much more
+                    buffering = max(self.buffer_records//PYRAMID_BRANCHING**level, 1)*values.itemsize
+                    self.pyramid_files[name].append(tuple(open(os.path.join(self.path, pyramid_file(name, kind, level)), 'wb', buffering=buffering)
+                                                          for kind in ('min', 'max')))
+                minimum_file, maximum_file = self.pyramid_files[name][level-1]
+                minimum_file.write(minimums.tobytes())
+                maximum_file.write(maximums.tobytes())
+            level += 1
+
+    def close(self):
+        self.record_queue.put(None)
+        self.writer_thread.join()
+
+
+class SessionStore:
+    #read side. record numbers are the strip chart x axis (sample numbers), times are record timestamps.
+    #a session that is still being written can be opened, it covers the records whose columns are complete
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SESSION_FILE)) as openfile:
+            self.header = json.load(openfile)
+        self.record_dtype = dtype_from_json(self.header['record_dtype'])
+        self.streams = self.header['streams']
+        self.index_stride = self.header['index_stride']
+        self.pyramid_branching = self.header.get('pyramid', {}).get('branching', PYRAMID_BRANCHING)
+        self.columns = {}
+        self.pyramids = {} #channel -> (minimums, maximums) of level 1 and up. sessions written before the pyramid have none
+        self.refresh()
+
+    def refresh(self):
+        #maps whatever was written since the last call
+        n_records = min(os.path.getsize(self.column_path(name))//self.record_dtype.fields[name][0].itemsize for name in self.record_dtype.names)
+        for name in self.record_dtype.names:
+            field_dtype = self.record_dtype.fields[name][0]
+            self.columns[name] = np.memmap(self.column_path(name), dtype=field_dtype.base, mode='r', shape=(n_records,) + field_dtype.shape) if n_records else np.empty((0,) + field_dtype.shape, field_dtype.base)
+        n_blocks = min(os.path.getsize(os.path.join(self.path, TIME_INDEX_FILE))//8, n_records//self.index_stride)
+        self.time_index = np.memmap(os.path.join(self.path, TIME_INDEX_FILE), dtype='<f8', mode='r', shape=(n_blocks,)) if n_blocks else np.empty(0)
+        self.n_records = n_records
+        for name in self.header.get('pyramid', {}).get('channels', []):
+            field_dtype = self.record_dtype.fields[name][0]
+            levels = []
+            while True:
+                paths = [os.path.join(self.path, pyramid_file(name, kind, len(levels) + 1)) for kind in ('min', 'max')]
+                if not all(os.path.exists(path) for path in paths):
+                    break
+                #complete buckets of records that are already mapped
+                n_buckets = min(min(os.path.getsize(path) for path in paths)//field_dtype.itemsize, n_records//self.pyramid_branching**(len(levels) + 1))
+                if not n_buckets:
+                    break
+                levels.append(tuple(np.memmap(path, dtype=field_dtype, mode='r', shape=(n_buckets,)) for path in paths))
+            self.pyramids[name] = levels
+
+    def column_path(self, name):
+        return os.path.join(self.path, self.header['columns'][name])
+
+    def __len__(self):
+        return self.n_records
+
+    def channels(self):
+        return [stream['name'] for stream in self.streams]
+
+    def column(self, name):
+        #lazy (N, ...) view of one field, nothing is read until it is indexed
+        return self.columns[name]
+
+    def time_range(self):
+        #first and latest timestamp
+        if not self.n_records:
+            return None, None
+        latest = np.max(self.columns['timestamp'][len(self.time_index)*self.index_stride:]) #records after the last index entry
+        if len(self.time_index):
+            latest = max(latest, self.time_index[-1])
+        return float(self.columns['timestamp'][0]), float(latest)
+
+    def record_index(self, timestamp, side='left'):
+        #first record at or after timestamp ('left') or after it ('right'). one search in the index, one block of timestamps read
+        block = int(np.searchsorted(self.time_index, timestamp, side))
+        start = block*self.index_stride
+        running_maximum = np.maximum.accumulate(self.columns['timestamp'][start:start+self.index_stride])
+        if block:
+            running_maximum = np.maximum(running_maximum, self.time_index[block-1])
+        return start + int(np.searchsorted(running_maximum, timestamp, side))
+
+    def record_range(self, t_start=None, t_end=None):
+        #(start, end) record numbers of the records with t_start <= timestamp <= t_end
+        start = 0 if t_start is None else self.record_index(t_start, 'left')
+        end = self.n_records if t_end is None else self.record_index(t_end, 'right')
+        return start, max(start, end)
+
+    def records(self, start=0, end=None, channels=None):
+        #structured array of records start..end with the timestamp and the given channels (all by default)
+        names = ['timestamp'] + [name for name in (channels or self.record_dtype.names) if name != 'timestamp']
+        start, end = max(start, 0), self.n_records if end is None else min(end, self.n_records)
+        records = np.empty(max(end - start, 0), dtype=[(name, self.record_dtype.fields[name][0]) for name in names])
+        for name in names:
+            records[name] = self.columns[name][start:end]
+        return records
+
+    def query(self, t_start=None, t_end=None, channels=None):
+        #the records between two times, e.g. store.query(t0, t0 + 10, ['Accel Z'])
+        return self.records(*self.record_range(t_start, t_end), channels)
+
+    def rolling(self, channel, window, t_start=None, t_end=None):
+        #rolling mean, std, min and max over the last window records of every record in the time range, as a dict of arrays.
+        #window-1 records before the range are read too, so the first values are full windows unless the session starts there
+        start, end = self.record_range(t_start, t_end)
+        lead = min(window - 1, start)
+        values = np.asarray(self.columns[channel][start-lead:end], dtype=np.float64)
+        if not len(values):
+            empty = np.empty((0,) + values.shape[1:])
+            return {'timestamp':np.empty(0), 'mean':empty, 'std':empty, 'min':empty, 'max':empty}
+        #windows at the very start of the session are shorter, their missing records are nan
+        padded = np.concatenate((np.full((window - 1 - lead,) + values.shape[1:], np.nan), values))
+        windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0) #(N, ..., window) view, no copy
+        return {
+            'timestamp':np.asarray(self.columns['timestamp'][start:end]),
+            'mean':np.nanmean(windows, axis=-1),
+            'std':np.nanstd(windows, axis=-1),
+            'min':np.nanmin(windows, axis=-1),
+            'max':np.nanmax(windows, axis=-1)
+        }
+
+    def minmax(self, channel, start, end, bucket_size):
+        #min and max of every bucket_size records of a scalar channel, buckets aligned to multiples of bucket_size, from
+        #the raw records. returns bucket centres (record numbers), minimums, maximums
+        first, last = start//bucket_size, -(-end//bucket_size)
+        values = np.asarray(self.columns[channel][first*bucket_size:last*bucket_size])
+        n_full = len(values)//bucket_size
+        minimums = values[:n_full*bucket_size].reshape(n_full, bucket_size).min(axis=1)
+        maximums = values[:n_full*bucket_size].reshape(n_full, bucket_size).max(axis=1)
+        if len(values) > n_full*bucket_size: #end of the session
+            minimums = np.append(minimums, values[n_full*bucket_size:].min())
+            maximums = np.append(maximums, values[n_full*bucket_size:].max())
+        centres = (np.arange(first, first + len(minimums)) + 0.5)*bucket_size - 0.5
+        return centres, minimums, maximums
+
+    def stream_of_type(self, type_names):
+        for stream in self.streams:
+            if stream['type'] in type_names:
+                return stream['name']
+        raise ValueError(f'{self.path} has no {" or ".join(type_names)} stream')
+
+    def quaternions(self, t_start=None, t_end=None, channel=None):
+        #(N, 4) float64 (w, x, y, z), normalized. the sensor's quaternion stream unless channel names another one
+        channel = channel or self.stream_of_type(['QuaternionShapeSerialData', 'QuaternionSerialData'])
+        start, end = self.record_range(t_start, t_end)
+        return quaternion_math.normalize(np.asarray(self.columns[channel][start:end], dtype=np.float64))
+
+    def euler_angles(self, t_start=None, t_end=None, channel=None):
+        #(N, 3) float64 BNO055 (heading, roll, pitch) in degrees
+        channel = channel or self.stream_of_type(['EulerSerialData'])
+        start, end = self.record_range(t_start, t_end)
+        return np.asarray(self.columns[channel][start:end], dtype=np.float64)
+
+
+class SessionHistory:
+    #MinMaxHistory stand-in over one scalar channel of a SessionStore, so a StripChartRenderer scrubs a stored session
+    #with the same pan/zoom code. bucket sizes are powers of the branching, the curve does not shimmer while scrolling
+    def __init__(self, session_store, channel):
+        self.session_store = session_store
+        self.channel = channel
+
+    def __len__(self):
+        return len(self.session_store)
+
+    def query(self, x_start, x_end, n_pixels):
+        x_start = max(int(np.floor(x_start)), 0)
+        x_end = min(int(np.ceil(x_end)) + 1, len(self))
+        if x_end <= x_start:
+            return np.empty(0), np.empty(0)
+        samples_per_pixel = (x_end - x_start)/max(n_pixels, 1)
+        values = self.session_store.column(self.channel)
+        if samples_per_pixel <= 1:
+            return np.arange(x_start, x_end), np.asarray(values[x_start:x_end])
+        levels = self.session_store.pyramids.get(self.channel)
+        if levels is None:
+            #no stored pyramid, every record in view is read. at most one bucket (two points) per pixel
+            centres, minimums, maximums = self.session_store.minmax(self.channel, x_start, x_end, 2**int(np.ceil(np.log2(samples_per_pixel))))
+            return np.repeat(centres, 2), np.column_stack((minimums, maximums)).ravel()
+
+        #same walk as MinMaxHistory.query: the finest stored level with at most one bucket per pixel, the buckets
+        #at the end that are not stored yet come from finer levels
+        branching = self.session_store.pyramid_branching
+        level = 0
+        while level < len(levels) and branching**level < samples_per_pixel:
+            level += 1
+        x_parts, minimum_parts, maximum_parts = [], [], []
+        position = x_start
+        for current_level in range(level, 0, -1):
+            bucket_size = branching**current_level
+            minimums, maximums = levels[current_level-1]
+            first = position//bucket_size
+            last = min(-(-x_end//bucket_size), len(minimums))
+            if last > first:
+                x_parts.append((np.arange(first, last) + 0.5)*bucket_size - 0.5)
+                minimum_parts.append(np.asarray(minimums[first:last]))
+                maximum_parts.append(np.asarray(maximums[first:last]))
+                position = last*bucket_size
+            if position >= x_end:
+                break
+        if position < x_end:
+            raw = np.asarray(values[position:x_end])
+            x_parts.append(np.arange(position, x_end))
+            minimum_parts.append(raw)
+            maximum_parts.append(raw)
+        x = np.repeat(np.concatenate(x_parts), 2)
+        y = np.column_stack((np.concatenate(minimum_parts), np.concatenate(maximum_parts))).ravel()
+        return x, y
+
+
+class LogSchema:
+    #just what SessionWriter needs from a FrameSchema, rebuilt from a flight log header
+    def __init__(self, header, record_dtype):
+        self.header = header
+        self.record_dtype = record_dtype
+
+    def describe(self):
+        return {'streams':self.header['streams'], 'record_dtype':self.header['record_dtype']}
+
+
+def session_from_flight_log(log_path, session_path, chunk_records=65536):
+    #converts a binary flight log, e.g. one recorded before --session existed
+    header, records = open_flight_log(log_path)
+    session_writer = SessionWriter(session_path, LogSchema(header, records.dtype))
+    for start in range(0, len(records), chunk_records):
+        session_writer.write(np.asarray(records[start:start+chunk_records]))
+    session_writer.close()
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert a flight log to a session store, or summarize a session')
+    parser.add_argument('path', help='flight log (.imulog) to convert, or session directory')
+    parser.add_argument('--out', dest='session_path', help='session directory to write')
+    args = parser.parse_args()
+
+    if args.session_path:
+        session_from_flight_log(args.path, args.session_path)
+    session_store = SessionStore(args.session_path or args.path)
+    t_start, t_end = session_store.time_range()
+    print(f"{len(session_store)} records" + (f", {t_end - t_start:.1f} s" if t_start is not None else '') + f", channels: {', '.join(session_store.channels())}")
@@ -0,0 +1,172 @@
+import time
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+#header slots (int64) at the start of the shared block
+WRITE_CURSOR = 0
+READ_CURSOR = 1
+DROPPED_FRAMES = 2 #dropped by the producer: newest records that did not fit, or the head of a batch bigger than the ring
+OVERWRITTEN_FRAMES = 3 #drop-oldest only, unread records the producer wrote over, counted by the consumer
+WRITE_RESERVED = 4 #drop-oldest only, end of the write in progress. the consumer discards what it may have overwritten
+HEADER_SLOTS = 8 #64 bytes, leaves room for more counters
+
+#what write() does when the consumer is behind and the ring is full
+BLOCK = 'block' #wait for space, nothing is lost. the reader stalls and the serial link buffers (or drops) instead
+DROP_OLDEST = 'drop-oldest' #overwrite the oldest unread records, the consumer always gets the newest data
+DROP_NEWEST = 'drop-newest' #keep what fits and drop the rest of the batch
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+
+class SharedRingBuffer:
+    #lock-free single producer/single consumer ring of fixed width records in shared memory
+    #cursors only ever increase. the producer (SerialRead) owns the write cursor, the consumer (FlightDisplay) owns the read cursor
+    def __init__(self, record_dtype, capacity=16384, name=None, data_event=None, policy=DROP_NEWEST, space_event=None, block_interval=0.05):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown ring policy '{policy}', use one of {POLICIES}")
+        self.record_dtype = np.dtype(record_dtype)
+        #set by the producer after every write so the consumer can block instead of polling the cursors
+        self.data_event = data_event if data_event is not None else mp.Event()
+        self.policy = policy
+        #set by the consumer after every read, a blocked producer waits on it. block_interval bounds how late a cancel is noticed
+        self.space_event = space_event if space_event is not None else mp.Event()
+        self.block_interval = block_interval
+        self.blocked_s = 0.0 #producer side, time spent waiting for space
+        self.capacity = capacity
+        self.owner = name is None #creating process unlinks the block on close
+        size = HEADER_SLOTS*8 + capacity*self.record_dtype.itemsize
+        self.shared_memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=self.shared_memory.buf)
+        self.records = np.ndarray((capacity,), dtype=self.record_dtype, buffer=self.shared_memory.buf, offset=HEADER_SLOTS*8)
+        if self.owner:
+            self.header[:] = 0
+
+    #only the name (and the event) travels to the reader process, which attaches to the same block
+    def __getstate__(self):
+        return {'record_dtype':self.record_dtype, 'capacity':self.capacity, 'name':self.shared_memory.name, 'data_event':self.data_event,
+                'policy':self.policy, 'space_event':self.space_event, 'block_interval':self.block_interval}
+
+    def __setstate__(self, state):
+        self.__init__(state['record_dtype'], state['capacity'], state['name'], state['data_event'], state['policy'], state['space_event'], state['block_interval'])
+
+    #producer side
+    def write(self, records, cancel=None):
+        #returns the number of records written. with BLOCK, cancel() is checked every block_interval while waiting,
+        #e.g. the reader shutting down, and the records still waiting are then counted as dropped
+        if self.policy == DROP_OLDEST:
+            return self.overwrite(records)
+        n_written = self.write_free(records)
+        while self.policy == BLOCK and n_written < len(records):
+            if cancel is not None and cancel():
+                break
+            block_start = time.perf_counter()
+            self.space_event.clear()
+            if self.free() == 0: #read between the write and the clear
+                self.space_event.wait(self.block_interval)
+            self.blocked_s += time.perf_counter() - block_start
+            n_written += self.write_free(records[n_written:])
+        if n_written < len(records): #consumer is behind, count the rest
+            self.header[DROPPED_FRAMES] += len(records) - n_written
+        return n_written
+
+    def free(self):
+        return self.capacity - (int(self.header[WRITE_CURSOR]) - int(self.header[READ_CURSOR]))
+
+    def write_free(self, records):
+        n_records = min(len(records), self.free())
+        write_cursor = int(self.header[WRITE_CURSOR])
+        self.copy_in(write_cursor, records[:n_records])
+        self.header[WRITE_CURSOR] = write_cursor + n_records #publish only after the records are in place
+        if n_records:
+            self.data_event.set()
+        return n_records
+
+    def overwrite(self, records):
+        #drop-oldest: never waits. the consumer finds out what was overwritten from the cursors, see read()
+        if len(records) > self.capacity:
+            self.header[DROPPED_FRAMES] += len(records) - self.capacity
+            records = records[-self.capacity:]
+        write_cursor = int(self.header[WRITE_CURSOR])
+        self.header[WRITE_RESERVED] = write_cursor + len(records) #announced before any slot is touched
+        self.copy_in(write_cursor, records)
+        self.header[WRITE_CURSOR] = write_cursor + len(records)
+        if len(records):
+            self.data_event.set()
+        return len(records)
+
+    def copy_in(self, write_cursor, records):
+        n_records = len(records)
+        start = write_cursor % self.capacity
+        first_part = min(n_records, self.capacity - start)
+        self.records[start:start+first_part] = records[:first_part]
+        self.records[:n_records-first_part] = records[first_part:]
+
+    #consumer side
+    def available(self):
+        return min(int(self.header[WRITE_CURSOR] - self.header[READ_CURSOR]), self.capacity)
+
+    def wait(self, timeout=None):
+        #blocks until there is something to read or timeout passes. returns whether records are available
+        if self.available():
+            return True
+        self.data_event.clear()
+        if self.available(): #written between the check and the clear
+            return True
+        self.data_event.wait(timeout)
+        return self.available() > 0
+
+    def peek(self):
+        #zero-copy view of the unread records up to the end of the storage. call release() when done with it
+        #not for DROP_OLDEST, the producer may write over the view while it is used. read() handles that
+        read_cursor = int(self.header[READ_CURSOR])
+        start = read_cursor % self.capacity
+        n_records = min(int(self.header[WRITE_CURSOR]) - read_cursor, self.capacity - start)
+        return self.records[start:start+n_records]
+
+    def discard(self):
+        #skips everything unread, e.g. what queued up before the consumer started
+        self.header[READ_CURSOR] = self.header[WRITE_CURSOR]
+        if self.policy == BLOCK:
+            self.space_event.set()
+
+    def release(self, n_records):
+        self.header[READ_CURSOR] += n_records
+        if self.policy == BLOCK:
+            self.space_event.set()
+
+    def read(self):
+        #copy of every unread record, including ones that wrapped around
+        if self.policy != DROP_OLDEST:
+            records = self.peek().copy()
+            self.release(len(records))
+            wrapped_records = self.peek()
+            if len(wrapped_records):
+                records = np.concatenate((records, wrapped_records))
+                self.release(len(wrapped_records))
+            return records
+
+        #drop-oldest: skip what was overwritten before the copy, then discard what the producer may have reached during it
+        write_cursor = int(self.header[WRITE_CURSOR])
+        read_cursor = int(self.header[READ_CURSOR])
+        if write_cursor - read_cursor > self.capacity:
+            self.header[OVERWRITTEN_FRAMES] += write_cursor - self.capacity - read_cursor
+            read_cursor = write_cursor - self.capacity
+        start = read_cursor % self.capacity
+        indices = (start + np.arange(write_cursor - read_cursor)) % self.capacity
+        records = self.records[indices] #one gathered copy
+        n_overwritten = min(int(self.header[WRITE_RESERVED]) - self.capacity - read_cursor, len(records))
+        if n_overwritten > 0:
+            self.header[OVERWRITTEN_FRAMES] += n_overwritten
+            records = records[n_overwritten:]
+        self.header[READ_CURSOR] = write_cursor
+        return records
+
+    def dropped_frames(self):
+        #exact count of records that never reached the consumer, whatever the policy
+        return int(self.header[DROPPED_FRAMES] + self.header[OVERWRITTEN_FRAMES])
+
+    def close(self):
+        del self.header, self.records #views must go before the mapping can close
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
@@ -0,0 +1,125 @@
+import threading
+import numpy as np
+
+#live power spectra of IMU channels. SlidingSpectrum runs in FlightDisplay's data handler thread: every hop_size samples a
+#window_size window is due, and all windows due in a batch, for all channels, are windowed and transformed in one rfft call.
+#the GUI thread only draws the newest spectra (SpectrumView), so the refresh tick never does any FFT work
+FLOOR_DB = -200.0 #empty spectra and exact zeros, keeps log10 and the plots finite
+
+
+class SlidingSpectrum:
+    def __init__(self, channels, sample_rate_hz=100.0, window_size=256, hop_size=64, waterfall_rows=256):
+        self.channels = list(channels)
+        self.sample_rate_hz = sample_rate_hz
+        self.window_size = window_size
+        self.hop_size = hop_size #window_size - hop_size samples overlap, 75% by default
+        self.window = np.hanning(window_size)
+        #one-sided PSD in units**2/Hz. the bins between DC and nyquist are doubled
+        self.psd_scale = np.full(window_size//2 + 1, 2/(sample_rate_hz*np.sum(self.window**2)))
+        self.psd_scale[0] /= 2
+        if window_size % 2 == 0:
+            self.psd_scale[-1] /= 2
+        self.frequencies = np.fft.rfftfreq(window_size, 1/sample_rate_hz)
+
+        #samples not consumed by a window yet, (channels, samples). buffers only grow when a bigger batch arrives
+        self.samples = np.zeros((len(self.channels), 2*window_size))
+        self.fill = 0
+        self.windowed = np.empty((len(self.channels), 0, window_size))
+
+        #newest spectrum and the waterfall in dB. every row is written twice, so the newest waterfall_rows rows are always
+        #one contiguous slice without rolling the array
+        self.lock = threading.Lock()
+        self.latest_db = np.full((len(self.channels), len(self.frequencies)), FLOOR_DB, dtype=np.float32)
+        self.waterfall_rows = waterfall_rows
+        self.waterfall_db = np.full((2*waterfall_rows, len(self.channels), len(self.frequencies)), FLOOR_DB, dtype=np.float32)
+        self.next_row = 0
+        self.version = 0 #bumped for every new spectrum, views redraw when it changed
+
+    def add(self, records):
+        #data handler thread. returns the number of new spectra
+        n_records = len(records)
+        if n_records == 0:
+            return 0
+        if self.fill + n_records > self.samples.shape[1]:
+            samples = np.zeros((len(self.channels), max(self.fill + n_records, 2*self.samples.shape[1])))
+            samples[:, :self.fill] = self.samples[:, :self.fill]
+            self.samples = samples
+        for i, channel in enumerate(self.channels):
+            self.samples[i, self.fill:self.fill+n_records] = records[channel]
+        self.fill += n_records
+        if self.fill < self.window_size:
+            return 0
+
+        n_windows = (self.fill - self.window_size)//self.hop_size + 1
+        if self.windowed.shape[1] < n_windows:
+            self.windowed = np.empty((len(self.channels), n_windows, self.window_size))
+        windowed = self.windowed[:, :n_windows]
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples[:, :self.fill], self.window_size, axis=1)[:, ::self.hop_size][:, :n_windows]
+        np.multiply(frames, self.window, out=windowed)
+        spectra = np.fft.rfft(windowed, axis=-1) #(channels, windows, bins), numpy's pocketfft caches the plan per window_size
+        spectra_db = 10*np.log10(np.maximum((spectra.real**2 + spectra.imag**2)*self.psd_scale, 10**(FLOOR_DB/10))).astype(np.float32)
+
+        consumed = n_windows*self.hop_size
+        self.samples[:, :self.fill-consumed] = self.samples[:, consumed:self.fill]
+        self.fill -= consumed
+
+        rows = np.swapaxes(spectra_db[:, -self.waterfall_rows:], 0, 1) #(windows, channels, bins)
+        with self.lock:
+            for row in rows:
+                self.waterfall_db[self.next_row] = row
+                self.waterfall_db[self.next_row + self.waterfall_rows] = row
+                self.next_row = (self.next_row + 1) % self.waterfall_rows
+            self.latest_db[:] = rows[-1]
+            self.version += n_windows
+        return n_windows
+
+    def latest(self):
+        #copy of the newest spectrum of every channel in dB, (channels, bins)
+        with self.lock:
+            return self.latest_db.copy(), self.version
+
+    def waterfall(self, channel_index):
+        #(waterfall_rows, bins) in dB of one channel, oldest row first
+        with self.lock:
+            return self.waterfall_db[self.next_row:self.next_row+self.waterfall_rows, channel_index].copy(), self.version
+
+
+class SpectrumView:
+    #display object next to the data classes: add_plot_handler/update_plot, but fed by a SlidingSpectrum instead of a record field
+    #waterfall=None draws the newest spectrum of every channel as lines, a channel name draws that channel's waterfall
+    render_class = 'spectrum' #see render_scheduler, spectra are the first views slowed down when frames go over budget
+    def __init__(self, name, display, spectrum, waterfall=None, db_range=(-80, 20)):
+        self.name = name
+        self.display = display
+        self.spectrum = spectrum
+        self.waterfall_channel = None if waterfall is None else spectrum.channels.index(waterfall)
+        self.db_range = db_range
+        self.drawn_version = 0
+
+    def add_plot_handler(self, plot_widget):
+        from plot_renderers import SpectrumRenderer, WaterfallRenderer
+        if self.waterfall_channel is None:
+            self.renderer = SpectrumRenderer(plot_widget, self.spectrum.frequencies, self.spectrum.channels, self.db_range)
+        else:
+            self.renderer = WaterfallRenderer(plot_widget, self.spectrum.frequencies, self.spectrum.waterfall_rows, self.spectrum.hop_size/self.spectrum.sample_rate_hz,
+                                              self.spectrum.channels[self.waterfall_channel], self.db_range)
+
+    def has_new_data(self):
+        return self.spectrum.version != self.drawn_version
+
+    def update_plot(self):
+        if self.waterfall_channel is None:
+            spectra_db, self.drawn_version = self.spectrum.latest()
+        else:
+            spectra_db, self.drawn_version = self.spectrum.waterfall(self.waterfall_channel)
+        self.renderer.set_spectra(spectra_db)
+
+
+def imu_spectrum_views(prefix='', sample_rate_hz=100.0):
+    #one SlidingSpectrum over the six accel/gyro channels, drawn as lines and as an Accel Z waterfall
+    channels = [f'{prefix}{sensor} {axis}' for sensor in ('Accel', 'Gyro') for axis in 'XYZ']
+    spectrum = SlidingSpectrum(channels, sample_rate_hz)
+    return [
+        SpectrumView(f'{prefix}Spectrum', 'plotobj_spectrum', spectrum),
+        SpectrumView(f'{prefix}Accel Z Waterfall', 'plotobj_waterfall', spectrum, waterfall=f'{prefix}Accel Z')
+    ]
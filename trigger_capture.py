@@ -0,0 +1,202 @@
+import json
+import threading
+import numpy as np
+from flight_log import FlightLogWriter
+
+#event capture for long soak tests: instead of (or next to) the full flight log, only a window around every trigger is
+#written, each burst to its own flight log file. TriggerCapture has the log writers' write/close interface and runs
+#wherever they run (FlightDisplay's data handler thread, the headless capture loop)
+#conditions are evaluated on whole batches with numpy, the only python loop is over the triggers that fired in a batch
+
+
+class TriggerCondition:
+    #fires on the samples where the condition becomes true. the last sample of the previous batch is carried over,
+    #so a crossing between two batches is found too. component picks one value of a vector stream, e.g. Euler Data[1]
+    def __init__(self, field, component=None):
+        self.field = field
+        self.component = component
+        self.previous_value = None
+        self.previous_active = True #nothing fires on the very first sample, the stream may start past a threshold
+
+    def values(self, records):
+        values = records[self.field]
+        if self.component is not None:
+            values = values[:, self.component]
+        return values.astype(np.float64)
+
+    def fires(self, records):
+        values = self.values(records)
+        if not len(values):
+            return np.zeros(0, dtype=bool)
+        previous_values = np.concatenate(([values[0] if self.previous_value is None else self.previous_value], values[:-1]))
+        active = self.active(values, previous_values)
+        fired = active & ~np.concatenate(([self.previous_active], active[:-1]))
+        self.previous_value = values[-1]
+        self.previous_active = bool(active[-1])
+        return fired
+
+    def label(self):
+        return self.field if self.component is None else f'{self.field}[{self.component}]'
+
+
+class Threshold(TriggerCondition):
+    def __init__(self, field, level, above=True, component=None):
+        super().__init__(field, component)
+        self.level = level
+        self.above = above
+
+    def active(self, values, previous_values):
+        return values > self.level if self.above else values < self.level
+
+    def label(self):
+        return f"{super().label()} {'above' if self.above else 'below'} {self.level:g}"
+
+
+class Slope(TriggerCondition):
+    #crossing of level in one direction, e.g. rising through 0
+    def __init__(self, field, level, rising=True, component=None):
+        super().__init__(field, component)
+        self.level = level
+        self.rising = rising
+
+    def active(self, values, previous_values):
+        if self.rising:
+            return (previous_values < self.level) & (values >= self.level)
+        return (previous_values > self.level) & (values <= self.level)
+
+    def label(self):
+        return f"{super().label()} {'rising' if self.rising else 'falling'} through {self.level:g}"
+
+
+class RateOfChange(TriggerCondition):
+    #|change| per second above limit, with the nominal sample rate (batches only carry their arrival time)
+    def __init__(self, field, limit, sample_rate_hz=100.0, component=None):
+        super().__init__(field, component)
+        self.limit = limit
+        self.sample_rate_hz = sample_rate_hz
+
+    def active(self, values, previous_values):
+        return np.abs(values - previous_values)*self.sample_rate_hz > self.limit
+
+    def label(self):
+        return f'{super().label()} changing faster than {self.limit:g}/s'
+
+
+def parse_trigger(text, sample_rate_hz=100.0):
+    #'Accel Z:above:15', 'Gyro X:rate:500', 'Euler Data[2]:rising:0'. kinds: above, below, rising, falling, rate
+    field, kind, value = text.rsplit(':', 2)
+    component = None
+    if field.endswith(']'):
+        field, component = field[:-1].rsplit('[', 1)
+        component = int(component)
+    value = float(value)
+    if kind in ('above', 'below'):
+        return Threshold(field, value, kind == 'above', component)
+    if kind in ('rising', 'falling'):
+        return Slope(field, value, kind == 'rising', component)
+    if kind == 'rate':
+        return RateOfChange(field, value, sample_rate_hz, component)
+    raise ValueError(f"Unknown trigger kind '{kind}', use above, below, rising, falling or rate")
+
+
+class TriggerCapture:
+    #pre_s before and post_s after a trigger go to '<prefix>_<n>.imulog'. a trigger inside a running burst extends it.
+    #every trigger is appended to '<prefix>_events.jsonl' and kept as an event for the strip chart markers
+    def __init__(self, frame_schema, conditions, prefix='burst', pre_s=1.0, post_s=2.0, sample_rate_hz=100.0):
+        self.frame_schema = frame_schema
+        self.conditions = list(conditions)
+        for condition in self.conditions:
+            if condition.field not in frame_schema.record_dtype.names:
+                raise ValueError(f"Trigger on unknown stream '{condition.field}'")
+            shape = frame_schema.record_dtype.fields[condition.field][0].shape
+            if condition.component is None and shape:
+                raise ValueError(f"Trigger on vector stream '{condition.field}' needs a component, e.g. '{condition.field}[0]'")
+            if condition.component is not None and not (shape and 0 <= condition.component < shape[0]):
+                raise ValueError(f"Trigger component {condition.component} out of range for '{condition.field}'")
+        self.prefix = prefix
+        self.pre_records = max(int(round(pre_s*sample_rate_hz)), 0)
+        self.post_records = max(int(round(post_s*sample_rate_hz)), 0)
+
+        #pre-trigger ring, allocated once. ring_end is where the next record goes
+        self.pre_ring = np.zeros(self.pre_records, dtype=frame_schema.record_dtype)
+        self.ring_end = 0
+        self.ring_count = 0
+
+        self.burst_writer = None
+        self.post_remaining = 0 #records still to write into the open burst
+        self.n_bursts = 0
+        self.n_records = 0 #records seen so far, event positions are counted in these (the strip chart x axis)
+        self.events_file = open(f'{prefix}_events.jsonl', 'a')
+        self.event_lock = threading.Lock()
+        self.event_samples = []
+
+    def write(self, records):
+        condition_fired = np.array([condition.fires(records) for condition in self.conditions]).reshape(len(self.conditions), len(records))
+        trigger_indices = np.flatnonzero(condition_fired.any(axis=0))
+
+        position = 0 #records before this are handled
+        for trigger_index in trigger_indices:
+            if self.burst_writer is not None:
+                position = self.write_post(records, position, trigger_index)
+            if self.burst_writer is None:
+                self.open_burst(records, trigger_index)
+                position = trigger_index
+            self.post_remaining = self.post_records + 1 #the trigger sample itself and post_s after it
+            self.record_event(records, trigger_index, [condition.label() for condition, fired in zip(self.conditions, condition_fired) if fired[trigger_index]])
+        if self.burst_writer is not None:
+            self.write_post(records, position, len(records))
+        self.n_records += len(records)
+        self.remember(records)
+
+    def write_post(self, records, position, end):
+        #writes records[position:end] into the open burst as far as the post window reaches, closes the burst when it is done
+        n_records = min(end - position, self.post_remaining)
+        if n_records:
+            self.burst_writer.write(records[position:position+n_records].copy())
+            self.post_remaining -= n_records
+        if self.post_remaining == 0:
+            self.burst_writer.close()
+            self.burst_writer = None
+        return position + n_records
+
+    def open_burst(self, records, trigger_index):
+        self.n_bursts += 1
+        self.burst_path = f'{self.prefix}_{self.n_bursts:04d}.imulog'
+        self.burst_writer = FlightLogWriter(self.burst_path, self.frame_schema, extra_header={'trigger_time':float(records['timestamp'][trigger_index])})
+        #the last pre_records before the trigger: the end of the ring, then the start of this batch
+        from_batch = min(trigger_index, self.pre_records)
+        from_ring = min(self.pre_records - from_batch, self.ring_count)
+        if from_ring:
+            ring_indices = (self.ring_end - from_ring + np.arange(from_ring)) % self.pre_records
+            self.burst_writer.write(self.pre_ring[ring_indices])
+        if from_batch:
+            self.burst_writer.write(records[trigger_index-from_batch:trigger_index].copy())
+
+    def record_event(self, records, trigger_index, fired_by):
+        sample = self.n_records + int(trigger_index)
+        event = {'sample':sample, 'timestamp':float(records['timestamp'][trigger_index]), 'burst':self.burst_path, 'fired_by':fired_by}
+        self.events_file.write(json.dumps(event) + '\n')
+        with self.event_lock:
+            self.event_samples.append(sample)
+
+    def remember(self, records):
+        #keeps the newest pre_records records in the ring, at most two slice copies
+        if not self.pre_records or not len(records):
+            return
+        records = records[-self.pre_records:]
+        first = min(len(records), self.pre_records - self.ring_end)
+        self.pre_ring[self.ring_end:self.ring_end+first] = records[:first]
+        self.pre_ring[:len(records)-first] = records[first:]
+        self.ring_end = (self.ring_end + len(records)) % self.pre_records
+        self.ring_count = min(self.ring_count + len(records), self.pre_records)
+
+    def events(self):
+        #sample numbers of every trigger so far, for the strip chart markers
+        with self.event_lock:
+            return np.array(self.event_samples)
+
+    def close(self):
+        if self.burst_writer is not None:
+            self.burst_writer.close()
+            self.burst_writer = None
+        self.events_file.close()
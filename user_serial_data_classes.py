@@ -1,134 +1,160 @@
-import struct
 import numpy as np
 from math import sin, cos, acos, sqrt
-from collections import deque
-import pyqtgraph as pg
-from pyqtgraph.opengl import GLLinePlotItem, GLAxisItem
+import quaternion_math
+from minmax_history import MinMaxHistory
+from derived_channels import Magnitude, LowPass, HighPass, GyroIntegration, EulerToQuaternion
+#plotting lives in plot_renderers and is imported in add_plot_handler, so importing the data classes never loads Qt/OpenGL
 
 
 class QuaternionSerialData:
+    render_class = 'view3d' #see render_scheduler, 3D views are slowed down first when frames run over budget
     def __init__(self, name, display, dtype_format_specifier='f', dsize=4):
         self.name = name
         self.display = display
         self.dtype_format_specifier = dtype_format_specifier
         self.dsize = dsize
+        self.n_values = 4 #number of values of size dsize sent per packet
 
         self.center = np.array([0,0,0])
         self.vector = np.array([0,0,1])
 
     def add_plot_handler(self, plot_figure):
-        self.plothanlder = GLLinePlotItem(pos=[[0,0,0],[1,0,0]], width=2, antialias=False)
-        plot_figure.addItem(self.plothanlder)
-        plot_figure.addItem(GLAxisItem())
-        plot_figure.setCameraParams(azimuth=22.5,distance=3)
-
-    def get_data(self, serial_connection):
-        quat_data = []
-        for _ in range(4):
-            data, = struct.unpack(self.dtype_format_specifier, serial_connection.read(size=self.dsize))
-            quat_data.append(data)
-        return quat_data 
-    
+        from plot_renderers import LineRenderer3d
+        self.renderer = LineRenderer3d(plot_figure, [[0,0,0],[1,0,0]])
+
     def update_plot(self, quaternion_vector):
-        new_vector = Quaternion.from_value(quaternion_vector) * self.vector
-        self.plothanlder.setData(pos=[self.center,new_vector])
+        new_vector = quaternion_math.rotate_vectors(quaternion_vector, self.vector)
+        self.renderer.set_positions(np.array([self.center,new_vector]))
+
+    def update_plot_batch(self, quaternion_vectors):
+        #orientation only needs the newest sample
+        if len(quaternion_vectors):
+            self.update_plot(quaternion_vectors[-1])
 
 class QuaternionShapeSerialData:
+    render_class = 'view3d'
     def __init__(self, name, display, dtype_format_specifier='f', dsize=4):
         self.name = name
         self.display = display
         self.dtype_format_specifier = dtype_format_specifier
         self.dsize = dsize
+        self.n_values = 4 #number of values of size dsize sent per packet
 
         #define rectangular prism with point at top
-        self.vectors = [
-            [np.array([0,0,-1]),np.array([0.05,0.05,-1])],
-            [np.array([0,0,-1]),np.array([-0.05,0.05,-1])],
-            [np.array([0,0,-1]),np.array([-0.05,-0.05,-1])],
-            [np.array([0,0,-1]),np.array([0.05,-0.05,-1])],
-            [np.array([0.05,0.05,-1]),np.array([0.05,0.05,1.0])],
-            [np.array([-0.05,0.05,-1]),np.array([-0.05,0.05,1.0])],
-            [np.array([-0.05,-0.05,-1]),np.array([-0.05,-0.05,1.0])],
-            [np.array([0.05,-0.05,-1]),np.array([0.05,-0.05,1.0])],
-            [np.array([0.05,0.05,1.0]),np.array([0,0,1.25])],
-            [np.array([-0.05,0.05,1.0]),np.array([0,0,1.25])],
-            [np.array([-0.05,-0.05,1.0]),np.array([0,0,1.25])],
-            [np.array([0.05,-0.05,1.0]),np.array([0,0,1.25])]
-        ]
+        #each pair of rows is one line segment so the whole shape is a single vertex buffer
+        self.vertices = np.array([
+            [0,0,-1],[0.05,0.05,-1],
+            [0,0,-1],[-0.05,0.05,-1],
+            [0,0,-1],[-0.05,-0.05,-1],
+            [0,0,-1],[0.05,-0.05,-1],
+            [0.05,0.05,-1],[0.05,0.05,1.0],
+            [-0.05,0.05,-1],[-0.05,0.05,1.0],
+            [-0.05,-0.05,-1],[-0.05,-0.05,1.0],
+            [0.05,-0.05,-1],[0.05,-0.05,1.0],
+            [0.05,0.05,1.0],[0,0,1.25],
+            [-0.05,0.05,1.0],[0,0,1.25],
+            [-0.05,-0.05,1.0],[0,0,1.25],
+            [0.05,-0.05,1.0],[0,0,1.25]
+        ])
 
     def add_plot_handler(self, plot_figure):
-        self.line_handlers = []
-        for vector_set in self.vectors:
-            self.line_handlers.append(GLLinePlotItem(pos=[vector_set[0],vector_set[1]], width=2, antialias=False))
-            plot_figure.addItem(self.line_handlers[-1])
-        plot_figure.addItem(GLAxisItem())
-        plot_figure.setCameraParams(azimuth=22.5,distance=3)
-
-    def get_data(self, serial_connection):
-        quat_data = []
-        for _ in range(4):
-            data, = struct.unpack(self.dtype_format_specifier, serial_connection.read(size=self.dsize))
-            quat_data.append(data)
-        return quat_data 
-    
+        from plot_renderers import LineRenderer3d
+        self.renderer = LineRenderer3d(plot_figure, self.vertices, mode='lines')
+
     def update_plot(self, quaternion_vector):
-        #new_vector = Quaternion.from_value(quaternion_vector) * self.vector
-        quaternion = Quaternion.from_value(quaternion_vector)
-        for i, vector_set in enumerate(self.vectors):
-            vec_1_transform = quaternion * vector_set[0]
-            vec_2_transform = quaternion * vector_set[1]
-            self.line_handlers[i].setData(pos=[vec_1_transform,vec_2_transform])
-        #self.plothanlder.setData(pos=[self.center,new_vector])
+        #all 24 endpoints rotated in one matmul
+        self.renderer.set_positions(quaternion_math.rotate_vectors(quaternion_vector, self.vertices))
+
+    def update_plot_batch(self, quaternion_vectors):
+        #orientation only needs the newest sample
+        if len(quaternion_vectors):
+            self.update_plot(quaternion_vectors[-1])
 
 class GenericSerialData:
-    def __init__(self, name, display, dtype_format_specifier='f', dsize=4):
+    render_class = 'strip'
+    def __init__(self, name, display, dtype_format_specifier='f', dsize=4, window_size=1000, color=(255, 0, 0)):
         self.name = name
         self.display = display
         self.dtype_format_specifier = dtype_format_specifier
         self.dsize = dsize
+        self.n_values = 1 #number of values of size dsize sent per packet
 
-        self.x_data_array = list(range(1000))
-        self.y_data_array = deque([0]*1000)
+        self.window_size = window_size #samples shown while following live data
+        self.color = color #pen colour, streams sharing a strip chart are told apart by it
+        #whole-session history as a min/max pyramid, x is the sample number. replaced by a session_store.SessionHistory
+        #before add_plot_handler to scrub a stored session
+        self.history = MinMaxHistory(np.dtype(dtype_format_specifier))
 
     def add_plot_handler(self, current_plot):
-        current_plot.setYRange(-10,20, padding=0.05)
-        self.plot_handler = current_plot.plot(self.x_data_array, self.y_data_array, pen = pg.mkPen(color=(255, 0, 0)))
-
-    def get_data(self, serial_connection):
-        data, = struct.unpack(self.dtype_format_specifier, serial_connection.read(size=self.dsize))
-        return data
+        from plot_renderers import StripChartRenderer
+        self.renderer = StripChartRenderer(current_plot, self.history, self.window_size, self.color)
 
     def update_plot(self, data):
-            self.y_data_array.append(data) #this will update data in order.. need to define this more explicitly
-            self.y_data_array.popleft()
-            self.plot_handler.setData(self.x_data_array,self.y_data_array)
+        self.update_plot_batch(np.array([data]))
+
+    def update_plot_batch(self, samples):
+        #cost grows with the number of new samples and the plot width, not with the history length
+        if len(samples) == 0:
+            return
+        self.history.append(samples)
+        self.renderer.update(len(samples))
+
+    def set_markers(self, sample_indices):
+        #event lines, e.g. trigger_capture events. x is the sample number like the history
+        self.renderer.set_markers(sample_indices)
+
+    def scroll_to(self, sample):
+        self.renderer.scroll_to(sample)
 
 class EulerSerialData:
+    render_class = 'view3d'
     def __init__(self, name, display, dtype_format_specifier='f', dsize=4):
         self.name = name
         self.display = display
         self.dtype_format_specifier = dtype_format_specifier
         self.dsize = dsize
+        self.n_values = 3 #number of values of size dsize sent per packet
 
         self.center = np.array([0,0,0])
         self.vector = np.array([0,0,1])
 
-    def get_data(self, serial_connection):
-        euler_data = []
-        for _ in range(3):
-            data, = struct.unpack(self.dtype_format_specifier, serial_connection.read(size=self.dsize))
-            euler_data.append(data)
-        return euler_data
-    
     def update_plot(self, euler_angles):
-        new_vector = np.array([0,0,1]) #TODO replace with code to calucate new vector based on euler angles
-        self.plothanlder.setData(pos=[self.center,new_vector])
+        new_vector = quaternion_math.rotate_vectors(quaternion_math.from_euler(euler_angles), self.vector)
+        self.renderer.set_positions(np.array([self.center,new_vector]))
+
+    def update_plot_batch(self, euler_angle_sets):
+        if len(euler_angle_sets):
+            self.update_plot(euler_angle_sets[-1])
     
     def add_plot_handler(self, plot_figure):
-        self.plothanlder = GLLinePlotItem(pos=[[0,0,0],[1,0,0]], width=2, antialias=False)
-        plot_figure.addItem(self.plothanlder)
-        plot_figure.addItem(GLAxisItem())
-        plot_figure.setCameraParams(azimuth=22.5,distance=3)
+        from plot_renderers import LineRenderer3d
+        self.renderer = LineRenderer3d(plot_figure, [[0,0,0],[1,0,0]])
+
+
+def imu_data_streams(prefix=''):
+    #streams sent by the arduino sketch, this must be in order of which data is transmitted
+    return [
+        GenericSerialData(f'{prefix}Accel X', 'plotobj_strip_chart_1'),
+        GenericSerialData(f'{prefix}Accel Y', 'plotobj_strip_chart_2'),
+        GenericSerialData(f'{prefix}Accel Z', 'plotobj_strip_chart_3'),
+        GenericSerialData(f'{prefix}Gyro X', 'plotobj_strip_chart_4'),
+        GenericSerialData(f'{prefix}Gyro Y', 'plotobj_strip_chart_5'),
+        GenericSerialData(f'{prefix}Gyro Z', 'plotobj_strip_chart_6'),
+        EulerSerialData(f'{prefix}Euler Data','plotobj_Euler_Plot'),
+        QuaternionShapeSerialData(f'{prefix}Quat Data','plotobj_Quat_Plot')
+    ]
+
+def imu_derived_channels(prefix='', sample_rate_hz=100.0):
+    #computed by the reader from the streams above (see derived_channels), logged and plotted like them.
+    #display None logs a channel without plotting it. the filters and the gyro integration step at the nominal sample_rate_hz
+    return [
+        Magnitude(GenericSerialData(f'{prefix}Accel Magnitude', 'plotobj_strip_chart_3', color=(0, 255, 0)), [f'{prefix}Accel X', f'{prefix}Accel Y', f'{prefix}Accel Z']),
+        LowPass(GenericSerialData(f'{prefix}Accel X Low-pass', 'plotobj_strip_chart_1', color=(255, 255, 0)), f'{prefix}Accel X', cutoff_hz=2.0, sample_rate_hz=sample_rate_hz),
+        Magnitude(GenericSerialData(f'{prefix}Gyro Magnitude', 'plotobj_strip_chart_4', color=(0, 255, 0)), [f'{prefix}Gyro X', f'{prefix}Gyro Y', f'{prefix}Gyro Z']),
+        HighPass(GenericSerialData(f'{prefix}Gyro Z High-pass', 'plotobj_strip_chart_6', color=(255, 255, 0)), f'{prefix}Gyro Z', cutoff_hz=0.05, sample_rate_hz=sample_rate_hz),
+        GyroIntegration(QuaternionSerialData(f'{prefix}Gyro Orientation', 'plotobj_Quat_Plot'), [f'{prefix}Gyro X', f'{prefix}Gyro Y', f'{prefix}Gyro Z'], sample_rate_hz=sample_rate_hz),
+        EulerToQuaternion(QuaternionSerialData(f'{prefix}Euler Quat', None), f'{prefix}Euler Data')
+    ]
 
 
 #functions for quaternion plotting
@@ -178,23 +204,14 @@ class Quaternion:
             raise Exception(f"Multiplication with unknown type {type(b)}")
 
     def _multiply_with_quaternion(self, q2):
-        w1, x1, y1, z1 = self._val
-        w2, x2, y2, z2 = q2._val
-        w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
-        x = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
-        y = w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2
-        z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
-
-        result = Quaternion.from_value(np.array((w, x, y, z)))
+        result = Quaternion.from_value(quaternion_math.multiply(self._val, q2._val))
         return result
 
     def _multiply_with_vector(self, v):
-        q2 = Quaternion.from_value(np.append((0.0), v))
-        return (self * q2 * self.get_conjugate())._val[1:]
+        return quaternion_math.rotate_vectors(self._val, v)
 
     def get_conjugate(self):
-        w, x, y, z = self._val
-        result = Quaternion.from_value(np.array((w, -x, -y, -z)))
+        result = Quaternion.from_value(quaternion_math.conjugate(self._val))
         return result
 
     def __repr__(self):